@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the personal_data redaction, logging, export and
+hashing paths. Results are printed as JSON so runs can be compared:
+
+    ./benchmark.py --suite redaction --fields 20 --pairs 16 > run.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from encrypt_password import hash_passwords
+from filtered_logger import (PII_FIELDS, PseudonymEngine, RedactingFormatter,
+                             export_bulk, export_parallel, fetch_rows,
+                             filter_datum, get_logger, get_redaction_engine,
+                             row_messages)
+
+# SQLite file standing in for the MySQL users table
+STANDIN_DB = os.path.join(tempfile.gettempdir(), "personal_data_bench.db")
+
+
+def uncached_filter_datum(fields: List[str], redaction: str,
+                          message: str, separator: str) -> str:
+    """The original filter_datum, rebuilding its pattern on every call."""
+    pattern = r"|".join([f"(?<={field}=)[^{separator}]+" for field in fields])
+    return re.sub(pattern, redaction, message)
+
+
+def synthetic_fields(count: int) -> List[str]:
+    """Return PII_FIELDS padded with made-up field names up to count."""
+    extra = ["field_{}".format(i) for i in range(count - len(PII_FIELDS))]
+    return list(PII_FIELDS) + extra
+
+
+def synthetic_message(fields: List[str], pairs: int) -> str:
+    """Build a `k=v;` line of `pairs` pairs, every other one a field."""
+    parts = []
+    for i in range(pairs):
+        if i % 2 == 0:
+            key = fields[i % len(fields)]
+        else:
+            key = "public_{}".format(i)
+        parts.append("{}=value{};".format(key, i))
+    return "".join(parts)
+
+
+def generate_corpus(records: int, fields: List[str], pairs: int,
+                    pii_density: float, seed: int = 0) -> List[str]:
+    """
+    Build `records` log lines of `pairs` key=value pairs each, where a
+    pair names one of `fields` with probability pii_density.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(records):
+        parts = []
+        for i in range(pairs):
+            if rng.random() < pii_density:
+                key = rng.choice(fields)
+            else:
+                key = "public_{}".format(i)
+            value = "".join(rng.choice("abcdefghij0123456789@.-")
+                            for _ in range(rng.randint(4, 24)))
+            parts.append("{}={};".format(key, value))
+        corpus.append("".join(parts))
+    return corpus
+
+
+def records_per_second(redact: Callable[[str], str], message: str,
+                       records: int) -> float:
+    """Time `records` calls of redact and return the rate."""
+    start = time.perf_counter()
+    for _ in range(records):
+        redact(message)
+    return records / (time.perf_counter() - start)
+
+
+def redaction_paths(fields: List[str]) -> Dict[str, Callable[[str], None]]:
+    """
+    Return one callable per way of redacting a line. The logger path
+    uses get_logger, so it redacts PII_FIELDS whatever `fields` is and
+    only times the caller's side of the queue.
+    """
+    formatter = RedactingFormatter(fields)
+    tokens = get_redaction_engine(fields, "***", ";", "tokens")
+    # The listener's StreamHandler binds sys.stderr when it is created
+    with contextlib.redirect_stderr(open(os.devnull, "w")):
+        logger = get_logger()
+
+    def format_record(message: str):
+        """Format a fresh record, as a handler would."""
+        formatter.format(logging.LogRecord("user_data", logging.INFO, None,
+                                           None, message, None, None))
+
+    return {
+        "uncached": lambda m: uncached_filter_datum(fields, "***", m, ";"),
+        "filter_datum": lambda m: filter_datum(fields, "***", m, ";"),
+        "tokens": tokens.redact,
+        "formatter": format_record,
+        "logger": logger.info,
+    }
+
+
+def measure(func: Callable[[str], None], corpus: List[str]) -> dict:
+    """
+    Run func over the corpus twice: once timing every call, once
+    under tracemalloc to count the memory it allocates.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for message in corpus:
+        begin = time.perf_counter_ns()
+        func(message)
+        latencies.append(time.perf_counter_ns() - begin)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    tracemalloc.start()
+    for message in corpus:
+        func(message)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "records_per_sec": len(corpus) / elapsed,
+        "p50_us": latencies[len(latencies) // 2] / 1000,
+        "p99_us": latencies[int(len(latencies) * 0.99)] / 1000,
+        "peak_alloc_bytes": peak,
+        "retained_bytes": current,
+    }
+
+
+def bench_redaction(records: int = 20000, fields: int = 5, pairs: int = 8,
+                    pii_density: float = 0.5, seed: int = 0) -> dict:
+    """Measure every redaction path on one synthetic corpus."""
+    names = synthetic_fields(fields)
+    corpus = generate_corpus(records, names, pairs, pii_density, seed)
+    return {name: measure(func, corpus)
+            for name, func in redaction_paths(names).items()}
+
+
+def bench_backends(field_counts=(5, 50, 500), pair_counts=(8, 64),
+                   records: int = 2000) -> List[dict]:
+    """Sweep field count and message length for every backend."""
+    results = []
+    for count in field_counts:
+        fields = synthetic_fields(count)
+        for pairs in pair_counts:
+            message = synthetic_message(fields, pairs)
+            row = {"fields": count, "length": len(message)}
+            for backend in ("regex", "tokens"):
+                engine = get_redaction_engine(fields, "***", ";", backend)
+                row[backend] = records_per_second(engine.redact, message,
+                                                  records)
+            results.append(row)
+    return results
+
+
+def connect_standin() -> sqlite3.Connection:
+    """Stand-in for get_db that opens the local SQLite users table."""
+    return sqlite3.connect(STANDIN_DB)
+
+
+def build_standin(rows: int):
+    """Fill the stand-in database with `rows` synthetic users."""
+    if os.path.exists(STANDIN_DB):
+        os.remove(STANDIN_DB)
+    db = connect_standin()
+    db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, "
+               "email TEXT, phone TEXT, ssn TEXT, password TEXT, ip TEXT, "
+               "last_login TEXT, user_agent TEXT)")
+    db.executemany(
+        "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((i, "User {}".format(i), "user{}@example.com".format(i),
+          "(473) 401-4253", "261-72-6780", "K5?BMNv", "10.0.0.1",
+          "2019-11-14 06:14:24", "Mozilla/5.0") for i in range(rows)))
+    db.commit()
+    db.close()
+
+
+def bench_parallel_export(rows: int = 200000,
+                          worker_counts=(1, 2, 4)) -> List[dict]:
+    """Return the export throughput for each worker count."""
+    build_standin(rows)
+    results = []
+    with open(os.devnull, "w") as sink:
+        for workers in worker_counts:
+            start = time.perf_counter()
+            export_parallel(sink, workers, connect=connect_standin)
+            elapsed = time.perf_counter() - start
+            results.append({"workers": workers,
+                            "rows_per_sec": rows / elapsed})
+    os.remove(STANDIN_DB)
+    return results
+
+
+def bench_bulk_export(rows: int = 200000) -> dict:
+    """
+    Compare the per-row logging export with export_bulk in each format,
+    all writing to os.devnull.
+    """
+    build_standin(rows)
+    results = {}
+    with open(os.devnull, "w") as sink:
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(RedactingFormatter(PII_FIELDS))
+        logger = logging.getLogger("user_data_bench")
+        logger.propagate = False
+        logger.addHandler(handler)
+
+        start = time.perf_counter()
+        db = connect_standin()
+        cursor = db.cursor()
+        cursor.execute("SELECT * FROM users")
+        columns = [desc[0] for desc in cursor.description]
+        for message in row_messages(columns, fetch_rows(cursor, 1000)):
+            logger.warning(message)
+        db.close()
+        results["logging"] = rows / (time.perf_counter() - start)
+
+        for fmt in ("holberton", "csv", "jsonl"):
+            start = time.perf_counter()
+            export_bulk(sink, fmt, connect=connect_standin)
+            results[fmt] = rows / (time.perf_counter() - start)
+    os.remove(STANDIN_DB)
+    return results
+
+
+def parse_and_dump(message: str, fields: List[str]) -> str:
+    """Reference JSON redaction through a full json round trip."""
+    def walk(value):
+        """Redact the values of field keys at any depth."""
+        if isinstance(value, dict):
+            return {key: "***" if key in fields else walk(item)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [walk(item) for item in value]
+        return value
+    return json.dumps(walk(json.loads(message)))
+
+
+def json_payload(users: int) -> str:
+    """Return a JSON message holding `users` nested user objects."""
+    return json.dumps({"event": "export", "users": [
+        {"id": i, "name": "User {}".format(i),
+         "contact": {"email": "user{}@example.com".format(i),
+                     "phone": "(473) 401-4253"},
+         "ip": "10.0.0.1", "tags": ["a", "b"]} for i in range(users)]})
+
+
+def bench_json(sizes=(1, 1000), records: int = 200) -> List[dict]:
+    """Compare the json backend with a parse-and-dump round trip."""
+    engine = get_redaction_engine(PII_FIELDS, "***", ";", "json")
+    results = []
+    for users in sizes:
+        message = json_payload(users)
+        count = max(1, records * 10 // users)
+        results.append({
+            "bytes": len(message),
+            "stream": records_per_second(engine.redact, message, count),
+            "parse_and_dump": records_per_second(
+                lambda m: parse_and_dump(m, PII_FIELDS), message, count),
+        })
+    return results
+
+
+def user_activity_corpus(records: int, users: int,
+                         seed: int = 0) -> List[str]:
+    """
+    Build log lines for `users` users whose activity follows a Zipf
+    like curve, so a few users account for most lines.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(users)]
+    ids = rng.choices(range(users), weights, k=records)
+    return ["name=User {0};email=user{0}@example.com;action=view;"
+            "ip=10.0.0.{1};".format(i, i % 256) for i in ids]
+
+
+def bench_pseudonym(records: int = 50000, users: int = 5000) -> dict:
+    """Compare pseudonymization with and without the token memo."""
+    corpus = user_activity_corpus(records, users)
+    results = {}
+    for name, memo_size in (("no_memo", 0), ("memo", 65536)):
+        engine = PseudonymEngine(PII_FIELDS, b"benchmark key", ";",
+                                 memo_size=memo_size)
+        start = time.perf_counter()
+        for message in corpus:
+            engine.redact(message)
+        info = engine.replace.cache_info()
+        lookups = info.hits + info.misses
+        results[name] = {
+            "records_per_sec": records / (time.perf_counter() - start),
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
+    return results
+
+
+def bench_hashing(passwords: int = 64,
+                  worker_counts=(1, 2, 4, 8)) -> List[dict]:
+    """Return the bcrypt hashes/sec of hash_passwords per worker count."""
+    plain = ["password{}".format(i) for i in range(passwords)]
+    results = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        hash_passwords(plain, workers)
+        elapsed = time.perf_counter() - start
+        results.append({"workers": workers,
+                        "hashes_per_sec": passwords / elapsed})
+    return results
+
+
+def main():
+    """Run the chosen suite and print its results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--suite", default="redaction",
+                        choices=("redaction", "backends", "export",
+                                 "bulk", "json", "pseudonym", "hashing"))
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--fields", type=int, default=len(PII_FIELDS))
+    parser.add_argument("--pairs", type=int, default=8)
+    parser.add_argument("--pii-density", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.suite == "redaction":
+        results = bench_redaction(args.records, args.fields, args.pairs,
+                                  args.pii_density, args.seed)
+    elif args.suite == "backends":
+        results = bench_backends()
+    elif args.suite == "export":
+        results = bench_parallel_export()
+    elif args.suite == "bulk":
+        results = bench_bulk_export()
+    elif args.suite == "json":
+        results = bench_json()
+    elif args.suite == "pseudonym":
+        results = bench_pseudonym()
+    else:
+        results = bench_hashing()
+
+    json.dump({"suite": args.suite, "params": vars(args),
+               "results": results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
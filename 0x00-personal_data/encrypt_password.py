@@ -1,21 +1,93 @@
 #!/usr/bin/env python3
 
 """Encrypting passwords."""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+import json
+import math
+import os
+import time
 import bcrypt
 
+# Default number of hashes computed at once
+WORKERS = os.cpu_count() or 1
 
-def hash_password(password: str) -> bytes:
+# bcrypt cost used until calibrate_cost has stored one
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+# File holding the calibrated cost, in the working directory
+CONFIG_FILE = os.getenv("PERSONAL_DATA_BCRYPT_CONFIG", ".bcrypt.json")
+
+_rounds = None
+
+
+def get_rounds() -> int:
+    """
+    Return the bcrypt cost factor for new hashes.
+
+    Returns:
+        int: The calibrated cost from CONFIG_FILE, or DEFAULT_ROUNDS.
+    """
+    global _rounds
+    if _rounds is None:
+        _rounds = DEFAULT_ROUNDS
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                _rounds = json.load(f).get("rounds", DEFAULT_ROUNDS)
+    return _rounds
+
+
+def calibrate_cost(target: float = 0.25, save: bool = True) -> int:
+    """
+    Find the bcrypt cost whose verification takes about `target`
+    seconds on this machine.
+
+    Each extra round doubles the work, so one timing at a cheap cost is
+    enough to extrapolate.
+
+    Args:
+        target (float): The wanted verification latency, in seconds.
+        save (bool): Whether to store the result in CONFIG_FILE.
+
+    Returns:
+        int: The chosen cost factor.
+    """
+    global _rounds
+    probe = 8
+    salt = bcrypt.gensalt(rounds=probe)
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", salt)
+    elapsed = time.perf_counter() - start
+
+    rounds = probe + round(math.log2(target / elapsed))
+    rounds = max(MIN_ROUNDS, min(MAX_ROUNDS, rounds))
+
+    if save:
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump({"rounds": rounds, "target": target}, f)
+        _rounds = rounds
+    return rounds
+
+
+def hash_password(password: str, rounds: int = None) -> bytes:
     """
     Hash a password using bcrypt, with automatic salting.
 
     Args:
         password (str): The password to hash.
+        rounds (int): The cost factor, get_rounds() by default.
 
     Returns:
         bytes: The salted, hashed password as a byte string.
     """
+    if rounds is None:
+        rounds = get_rounds()
+
     # Generate a salt and hash the password with bcrypt
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=rounds)
     hashed_password = bcrypt.hashpw(password.encode(), salt)
 
     return hashed_password
@@ -33,3 +105,87 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
         bool: True if the password matches the hashed password, False otherwise
     """
     return bcrypt.checkpw(password.encode(), hashed_password)
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Tell whether a stored hash was made with another cost than the
+    current one.
+
+    Args:
+        hashed_password (bytes): The stored hash, `$2b$<cost>$...`.
+
+    Returns:
+        bool: True if the hash should be replaced.
+    """
+    return int(hashed_password.split(b"$")[2]) != get_rounds()
+
+
+def verify_and_rehash(hashed_password: bytes,
+                      password: str) -> Tuple[bool, Optional[bytes]]:
+    """
+    Validate a password and, when it matches a hash of an outdated
+    cost, hash it again with the current cost.
+
+    Args:
+        hashed_password (bytes): The hashed password to check against.
+        password (str): The plain text password to validate.
+
+    Returns:
+        tuple: Whether the password matches, and the new hash to store
+        or None if the stored one is current.
+    """
+    if not is_valid(hashed_password, password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, hash_password(password)
+    return True, None
+
+
+def _map_in_order(func: Callable, items: Iterable, workers: int) -> List:
+    """
+    Apply func to every item on a thread pool and return the results
+    in input order. bcrypt releases the GIL while hashing, so threads
+    run on separate cores. At most 2 * workers items are in flight.
+    """
+    results = []
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            if len(pending) >= 2 * workers:
+                results.append(pending.popleft().result())
+            pending.append(executor.submit(func, item))
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+
+def hash_passwords(passwords: Iterable[str],
+                   workers: int = WORKERS) -> List[bytes]:
+    """
+    Hash many passwords in parallel.
+
+    Args:
+        passwords (Iterable[str]): The passwords to hash.
+        workers (int): The number of hashes computed at once.
+
+    Returns:
+        List[bytes]: The hashed passwords, in input order.
+    """
+    return _map_in_order(hash_password, passwords, workers)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]],
+                workers: int = WORKERS) -> List[bool]:
+    """
+    Validate many (hashed_password, password) pairs in parallel.
+
+    Args:
+        pairs (Iterable[Tuple[bytes, str]]): The hashes and the plain
+        text passwords to check against them.
+        workers (int): The number of checks run at once.
+
+    Returns:
+        List[bool]: Whether each password matches, in input order.
+    """
+    return _map_in_order(lambda pair: is_valid(*pair), pairs, workers)
@@ -1,50 +1,658 @@
 #!/usr/bin/env python3
 
 """Log and filter data"""
+import atexit
+from contextlib import contextmanager
+import copy
+import csv
+import hashlib
+import hmac
+import json
 import logging
-from typing import List, Tuple
+import logging.handlers
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import (Callable, Dict, Iterable, Iterator, List, Mapping,
+                    TextIO, Tuple)
 import os
+from queue import Full, Queue
+import random
 import re
+import sys
+import threading
+import time
 import mysql.connector
 
 
+class RedactionEngine:
+    """Redact a fixed set of fields with a pattern compiled once."""
+
+    def __init__(self, fields: Tuple[str, ...], redaction: str,
+                 separator: str):
+        """Compile the alternation pattern for the given fields."""
+        self.fields = fields
+        self.redaction = redaction
+        self.separator = separator
+        self.pattern = re.compile(r"|".join(
+            [f"(?<={field}=)[^{separator}]+" for field in fields]))
+
+    def redact(self, message: str) -> str:
+        """Return the message with every field value obfuscated."""
+        return self.pattern.sub(self.redaction, message)
+
+    def replace(self, value: str) -> str:
+        """Return what a single field value is replaced with."""
+        return self.redaction
+
+
+class TokenRedactionEngine(RedactionEngine):
+    """
+    Redact in one pass by splitting on the separator and looking
+    each `field=` key up in a set, so the cost does not grow with the
+    number of fields.
+
+    The output is identical to the regex engine. Inputs the regex would
+    read differently from their literal text (metacharacters, escapes
+    in the redaction, multi-character separators) use the regex path.
+    """
+
+    def __init__(self, fields: Tuple[str, ...], redaction: str,
+                 separator: str):
+        """Index the fields by name and by length."""
+        super().__init__(fields, redaction, separator)
+        self.keys = frozenset(fields)
+        self.lengths = sorted({len(field) for field in fields})
+        self.literal = (
+            len(fields) > 0
+            and len(separator) == 1 and separator != "="
+            and re.escape(separator) == separator
+            and "\\" not in redaction
+            and all(re.escape(field) == field and separator not in field
+                    for field in fields))
+
+    def redact_segment(self, segment: str) -> str:
+        """Redact the text between two separators."""
+        end = segment.find("=")
+        while end != -1 and end + 1 < len(segment):
+            # The regex matches after the first `=` preceded by any field
+            for length in self.lengths:
+                if length > end:
+                    break
+                if segment[end - length:end] in self.keys:
+                    return segment[:end + 1] + self.redaction
+            end = segment.find("=", end + 1)
+        return segment
+
+    def redact(self, message: str) -> str:
+        """Return the message with every field value obfuscated."""
+        if not self.literal:
+            return super().redact(message)
+        return self.separator.join(
+            [self.redact_segment(segment)
+             for segment in message.split(self.separator)])
+
+
+class JsonRedactionEngine(RedactionEngine):
+    """
+    Redact JSON messages: the value of every object key named in
+    fields, nested or not, becomes the redaction as a JSON string.
+
+    Only the redacted values are rewritten, so nothing is parsed into
+    objects or dumped again. Without backslashes in the message, one
+    regex skips every other string and finds the next field key; with
+    them, keys may be escaped and the message is walked token by token.
+    """
+
+    TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]:]')
+    SCALAR = re.compile(r'[^,}\]\s]*')
+    SPACE = re.compile(r'\s*')
+
+    def __init__(self, fields: Tuple[str, ...], redaction: str,
+                 separator: str):
+        """Compile the key finder; the separator is unused."""
+        super().__init__(fields, redaction, separator)
+        self.keys = frozenset(fields)
+        self.replacement = json.dumps(redaction)
+        names = "|".join(
+            re.escape(json.dumps(field, ensure_ascii=False)[1:-1])
+            for field in self.keys)
+        # Skip other text and strings, then match a field key. The skip
+        # sits in a lookahead captured by \1 so it never backtracks
+        self.next_key = re.compile(
+            rf'(?=((?:[^"]+|"(?!(?:{names})"\s*:)[^"]*")*))\1'
+            rf'"(?:{names})"\s*:\s*')
+
+    def value_end(self, message: str, start: int) -> int:
+        """Return the offset just past the JSON value at start."""
+        if message.startswith('"', start):
+            string = self.TOKEN.match(message, start)
+            # A truncated message may never close the string
+            return string.end() if string is not None else len(message)
+        if not message.startswith(("{", "["), start):
+            return self.SCALAR.match(message, start).end()
+        depth = 0
+        for token in self.TOKEN.finditer(message, start):
+            char = token.group()
+            if char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+                if depth == 0:
+                    return token.end()
+        return len(message)
+
+    def escaped_value_starts(self, message: str) -> Iterator[int]:
+        """
+        Yield the offset of each value to redact, decoding every string
+        that may be a key. The caller sends back where the value ended.
+        """
+        position = 0
+        while True:
+            token = self.TOKEN.search(message, position)
+            if token is None:
+                return
+            position = token.end()
+            text = token.group()
+            if text[0] != '"':
+                continue
+            colon = self.SPACE.match(message, position).end()
+            if not message.startswith(":", colon):
+                continue
+            key = json.loads(text) if "\\" in text else text[1:-1]
+            if key in self.keys:
+                position = yield self.SPACE.match(message, colon + 1).end()
+
+    def redact_escaped(self, message: str) -> str:
+        """Redact a message whose keys may contain escapes."""
+        parts = []
+        copied = 0
+        starts = self.escaped_value_starts(message)
+        start = next(starts, None)
+        while start is not None:
+            end = self.value_end(message, start)
+            parts.append(message[copied:start])
+            parts.append(self.replacement)
+            copied = end
+            try:
+                start = starts.send(end)
+            except StopIteration:
+                break
+        parts.append(message[copied:])
+        return "".join(parts)
+
+    def redact(self, message: str) -> str:
+        """Return the message with every field value obfuscated."""
+        if not self.keys:
+            return message
+        if "\\" in message:
+            return self.redact_escaped(message)
+
+        parts = []
+        copied = 0
+        next_key = self.next_key.match
+        while True:
+            match = next_key(message, copied)
+            if match is None:
+                break
+            start = match.end()
+            if message.startswith('"', start):
+                # No backslashes, so the next quote closes the string
+                end = message.find('"', start + 1) + 1 or len(message)
+            else:
+                end = self.value_end(message, start)
+            parts.append(message[copied:start])
+            parts.append(self.replacement)
+            copied = end
+        parts.append(message[copied:])
+        return "".join(parts)
+
+
+# Redaction backends selectable by name
+REDACTION_BACKENDS = {
+    "regex": RedactionEngine,
+    "tokens": TokenRedactionEngine,
+    "json": JsonRedactionEngine,
+}
+
+# Number of distinct (fields, redaction, separator) engines kept alive
+ENGINE_CACHE_SIZE = 128
+
+# Hex digits kept from each pseudonym token, and tokens memoized per engine
+PSEUDONYM_LENGTH = 12
+PSEUDONYM_MEMO_SIZE = 65536
+
+
+@lru_cache(maxsize=ENGINE_CACHE_SIZE)
+def _cached_engine(fields: Tuple[str, ...], redaction: str,
+                   separator: str, backend: str) -> RedactionEngine:
+    """Build the engine for a hashable key; the LRU bounds the cache."""
+    return REDACTION_BACKENDS[backend](fields, redaction, separator)
+
+
+def get_redaction_engine(fields: List[str], redaction: str,
+                         separator: str,
+                         backend: str = "regex") -> RedactionEngine:
+    """Return the cached redaction engine for these fields."""
+    return _cached_engine(tuple(fields), redaction, separator, backend)
+
+
+class PseudonymEngine(RedactionEngine):
+    """
+    Replace each field value with a keyed HMAC-SHA256 token, truncated
+    to `length` hex digits, so one user's values stay correlatable
+    without being readable. Tokens of recently seen values are memoized
+    in a bounded LRU.
+    """
+
+    def __init__(self, fields: Tuple[str, ...], key: bytes, separator: str,
+                 length: int = PSEUDONYM_LENGTH,
+                 memo_size: int = PSEUDONYM_MEMO_SIZE):
+        """Compile the field pattern and set up the token memo."""
+        super().__init__(fields, "", separator)
+        self.key = key
+        self.length = length
+        self.replace = lru_cache(maxsize=memo_size)(self.token)
+        # Identifies the key in caches without keeping the key itself
+        self.fingerprint = hashlib.sha256(key).hexdigest()[:16]
+
+    def token(self, value: str) -> str:
+        """Return the HMAC token of a value."""
+        digest = hmac.new(self.key, value.encode(), hashlib.sha256)
+        return digest.hexdigest()[:self.length]
+
+    def redact(self, message: str) -> str:
+        """Return the message with every field value pseudonymized."""
+        return self.pattern.sub(lambda match: self.replace(match.group()),
+                                message)
+
+
+@lru_cache(maxsize=ENGINE_CACHE_SIZE)
+def _cached_pseudonym_engine(fields: Tuple[str, ...], key: bytes,
+                             separator: str, length: int) -> PseudonymEngine:
+    """Build the pseudonym engine for a hashable key."""
+    return PseudonymEngine(fields, key, separator, length)
+
+
+def get_pseudonym_engine(fields: List[str], key: bytes, separator: str,
+                         length: int = PSEUDONYM_LENGTH) -> PseudonymEngine:
+    """Return the cached pseudonym engine for these fields and key."""
+    return _cached_pseudonym_engine(tuple(fields), key, separator, length)
+
+
 def filter_datum(fields: List[str], redaction: str,
-                 message: str, separator: str) -> str:
-    """Obfuscate the log message."""
-    pattern = r"|".join([f"(?<={field}=)[^{separator}]+" for field in fields])
-    return re.sub(pattern, redaction, message)
+                 message: str, separator: str,
+                 pseudonym_key: bytes = None) -> str:
+    """
+    Obfuscate the log message. With a pseudonym_key, values become HMAC
+    tokens instead of the redaction.
+    """
+    if pseudonym_key is not None:
+        engine = get_pseudonym_engine(fields, pseudonym_key, separator)
+    else:
+        engine = get_redaction_engine(fields, redaction, separator)
+    return engine.redact(message)
 
 
 class RedactingFormatter(logging.Formatter):
     """ Redacting Formatter class
-        """
+
+    A record logged with `extra={"fields": mapping}` is rendered as
+    `key=value; ` pairs, redacted by key lookup instead of a regex scan.
+    The output is cached on the record, so other handlers using an
+    equivalent formatter reuse it; record.msg is never modified.
+    """
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], backend: str = "regex",
+                 pseudonym_key: bytes = None,
+                 pseudonym_length: int = PSEUDONYM_LENGTH):
         """Intialize."""
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.keys = frozenset(fields)
+        if pseudonym_key is not None:
+            self.engine = get_pseudonym_engine(fields, pseudonym_key,
+                                               self.SEPARATOR,
+                                               pseudonym_length)
+            backend = ("pseudonym", self.engine.fingerprint,
+                       pseudonym_length)
+        else:
+            self.engine = get_redaction_engine(fields, self.REDACTION,
+                                               self.SEPARATOR, backend)
+        self.cache_key = (self._fmt, self.datefmt, self.engine.fields,
+                          self.REDACTION, self.SEPARATOR, backend)
+
+    def redact_message(self, record: logging.LogRecord) -> str:
+        """Return the record's message, args included, with PII removed."""
+        message = record.getMessage()
+        if message:
+            message = self.engine.redact(message)
+        fields = getattr(record, "fields", None)
+        if not isinstance(fields, Mapping):
+            return message
+
+        replace = self.engine.replace
+        pairs = "; ".join(
+            f"{key}={replace(str(value)) if key in self.keys else value}"
+            for key, value in fields.items()) + ";"
+        return f"{message} {pairs}" if message else pairs
 
     def format(self, record: logging.LogRecord) -> str:
         """Format."""
-        record.msg = filter_datum(self.fields,
-                                  self.REDACTION, record.msg, self.SEPARATOR)
-        return super().format(record)
+        cached = getattr(record, "redacted_output", None)
+        if cached is not None and cached[0] == self.cache_key:
+            return cached[1]
+        return self.format_redacted(record, self.redact_message(record))
+
+    def format_redacted(self, record: logging.LogRecord,
+                        message: str) -> str:
+        """Format the record around an already redacted message."""
+        # Format a shallow copy so the caller's record keeps its msg/args
+        redacted = copy.copy(record)
+        redacted.msg = message
+        redacted.args = None
+        output = super().format(redacted)
+
+        record.redacted_output = (self.cache_key, output)
+        return output
 
 
 PII_FIELDS: Tuple[str] = ('name', 'email', 'phone', 'ssn', 'password')
 
+# Rows fetched per round trip when exporting the users table
+BATCH_SIZE = 1000
+
+# Connections kept by the pool and seconds to wait for a free one
+POOL_SIZE = 5
+POOL_TIMEOUT = 30.0
+
+# Primary-key values covered by one task of the parallel export
+RANGE_SIZE = 10000
+
+# Monotonic column and state file of the incremental export
+WATERMARK_COLUMN = "last_login"
+WATERMARK_FILE = os.getenv("PERSONAL_DATA_WATERMARK_FILE",
+                           ".export_watermark.json")
+
+
+def snapshot_record(record: logging.LogRecord) -> logging.LogRecord:
+    """
+    Return a copy of the record with its message and traceback rendered
+    now, for handlers that format it later: changes the caller makes to
+    the args or the fields afterwards do not reach the log.
+    """
+    record = copy.copy(record)
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+        if not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        record.exc_info = None
+    fields = getattr(record, "fields", None)
+    if isinstance(fields, Mapping):
+        record.fields = dict(fields)
+    return record
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to a background listener through a bounded queue.
+
+    With the "block" policy a full queue makes the caller wait; with
+    "drop" the record is discarded and counted in `dropped`.
+    """
+
+    def __init__(self, queue: Queue, overflow: str = "block"):
+        """Initialize with the queue and its overflow policy."""
+        if overflow not in ("block", "drop"):
+            raise ValueError("overflow must be 'block' or 'drop'")
+        super().__init__(queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Enqueue a snapshot of the record. Redaction and formatting are
+        left to the listener.
+        """
+        return snapshot_record(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        """Put the record on the queue according to the overflow policy."""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class BatchRedactingHandler(logging.StreamHandler):
+    """
+    Buffer records and redact them together.
+
+    The buffer is flushed once it holds `capacity` records, `interval`
+    seconds after its first record, on a record at `flush_level` or
+    above, and on shutdown. The buffered messages are joined with a
+    sentinel, redacted in one pass and written with a single call; the
+    output is the same as formatting each record on its own.
+    """
+
+    # Starts with the separator, so no value match runs across records
+    SENTINEL = RedactingFormatter.SEPARATOR + "\x00"
+
+    def __init__(self, stream: TextIO = None, capacity: int = 100,
+                 interval: float = 0.05, flush_level: int = logging.ERROR,
+                 fields: List[str] = PII_FIELDS):
+        """Initialize an empty buffer in front of stream."""
+        super().__init__(stream)
+        self.setFormatter(RedactingFormatter(fields))
+        self.capacity = capacity
+        self.interval = interval
+        self.flush_level = flush_level
+        self.buffer = []
+        self._timer = None
+
+    def emit(self, record: logging.LogRecord):
+        """
+        Buffer a snapshot of the record, as it is redacted later, and
+        flush when a trigger is reached.
+        """
+        self.buffer.append(snapshot_record(record))
+        if len(self.buffer) >= self.capacity \
+                or record.levelno >= self.flush_level:
+            self.flush_buffer()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def redact_batch(self, records: List[logging.LogRecord]) -> List[str]:
+        """Return the redacted message of every record, in order."""
+        formatter = self.formatter
+        messages = [None] * len(records)
+        plain = []
+        for i, record in enumerate(records):
+            if isinstance(getattr(record, "fields", None), Mapping):
+                messages[i] = formatter.redact_message(record)
+            else:
+                plain.append(i)
+
+        texts = [records[i].getMessage() for i in plain]
+        redacted = formatter.engine.redact(
+            self.SENTINEL.join(texts)).split(self.SENTINEL)
+        if len(redacted) != len(texts) \
+                or any("\x00" in field for field in formatter.fields):
+            # The sentinel occurs in the data: redact one by one
+            redacted = [formatter.engine.redact(text) for text in texts]
+        for i, text in zip(plain, redacted):
+            messages[i] = text
+        return messages
+
+    def flush_buffer(self):
+        """Redact and write every buffered record."""
+        records, self.buffer = self.buffer, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not records:
+            return
+
+        formatter = self.formatter
+        self.stream.write("".join(
+            formatter.format_redacted(record, message) + self.terminator
+            for record, message in zip(records,
+                                       self.redact_batch(records))))
+        super().flush()
+
+    def flush(self):
+        """Write out the buffer."""
+        with self.lock:
+            self.flush_buffer()
+
+    def close(self):
+        """Flush the buffer, then close."""
+        self.flush()
+        super().close()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drop records before any handler sees them.
+
+    Each level keeps a `ratios[level]` share of its records, picked at
+    random, and a token bucket caps what is left at `rate` records/sec
+    with bursts of up to `burst`. A summary of the drops is logged at
+    most once per `interval` seconds, by a timer the first drop after
+    the last summary starts, and when the filter is closed: on exit or
+    when set_sampling replaces it.
+    """
+
+    def __init__(self, logger: logging.Logger,
+                 ratios: Dict[int, float] = None, rate: float = None,
+                 burst: int = None, interval: float = 60.0):
+        """Initialize the counters and a full bucket."""
+        super().__init__()
+        self.logger = logger
+        self.ratios = ratios or {}
+        self.rate = rate
+        # Below one token no record would ever pass
+        self.burst = burst or (max(1, rate) if rate is not None else None)
+        self.interval = interval
+        self.tokens = self.burst
+        self.sampled_out = 0
+        self.rate_limited = 0
+        self._refilled = self._reported = time.monotonic()
+        self._timer = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Return whether the record may go on to the handlers."""
+        if getattr(record, "sampling_summary", False):
+            return True
+
+        ratio = self.ratios.get(record.levelno, 1.0)
+        if ratio < 1.0 and random.random() >= ratio:
+            with self._lock:
+                self.sampled_out += 1
+                self.schedule_report()
+            return False
+
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens
+                              + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self.tokens < 1:
+                self.rate_limited += 1
+                self.schedule_report()
+                return False
+            self.tokens -= 1
+        return True
+
+    def schedule_report(self):
+        """Start the timer of the next summary; hold the lock to call."""
+        if self._timer is not None:
+            return
+        delay = self.interval - (time.monotonic() - self._reported)
+        self._timer = threading.Timer(max(0.0, delay), self.report)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def report(self):
+        """Log a summary of the drops counted since the last one."""
+        now = time.monotonic()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            summary = None
+            if self.sampled_out or self.rate_limited:
+                summary = (self.sampled_out, self.rate_limited,
+                           now - self._reported)
+            self.sampled_out = self.rate_limited = 0
+            self._reported = now
+
+        if summary is not None:
+            self.logger.warning(
+                "dropped %d sampled out and %d rate limited records "
+                "in the last %.0fs", *summary,
+                extra={"sampling_summary": True})
 
-def get_logger() -> logging.Logger:
+    def close(self):
+        """Log the drops not summarized yet; the filter is done."""
+        atexit.unregister(self.close)
+        self.report()
+
+
+def set_sampling(logger: logging.Logger,
+                 sample_ratios: Dict[int, float] = None,
+                 rate_limit: float = None):
+    """Replace the SamplingFilter of logger when sampling is asked for."""
+    if not sample_ratios and rate_limit is None:
+        return
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, SamplingFilter):
+            logger.removeFilter(log_filter)
+            log_filter.close()
+    logger.addFilter(SamplingFilter(logger, sample_ratios, rate_limit))
+
+
+# Records buffered between the logger and its background listener
+QUEUE_SIZE = 10000
+
+
+def get_logger(queue_size: int = QUEUE_SIZE, overflow: str = "block",
+               sample_ratios: Dict[int, float] = None,
+               rate_limit: float = None) -> logging.Logger:
     """
     Creates and returns a logger object
     that obfuscates sensitive information.
+
+    Redaction and output happen on a background listener thread, so
+    callers only pay for putting the record on a queue. Calling it again
+    returns the already configured logger.
+
+    sample_ratios (share kept per level) and rate_limit (records/sec)
+    add a SamplingFilter that drops records before they are redacted;
+    passed again later, they replace the filter of the configured logger.
     """
 
     # Create a logger with the name 'user_data'
     logger = logging.getLogger("user_data")
+    for handler in logger.handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            set_sampling(logger, sample_ratios, rate_limit)
+            return logger
 
     # Set the logger level to INFO
     logger.setLevel(logging.INFO)
@@ -59,8 +667,17 @@ def get_logger() -> logging.Logger:
     formatter = RedactingFormatter(PII_FIELDS)
     handler.setFormatter(formatter)
 
-    # Add the handler to the logger
-    logger.addHandler(handler)
+    # The listener drains the queue into the StreamHandler on its own thread
+    log_queue = Queue(maxsize=queue_size)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # Drop sampled out and rate limited records before the queue
+    set_sampling(logger, sample_ratios, rate_limit)
+
+    # Add the queue handler to the logger
+    logger.addHandler(BoundedQueueHandler(log_queue, overflow))
 
     return logger
 
@@ -85,9 +702,379 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     )
 
 
-def main():
+def ping(db) -> bool:
+    """Return True if the connection still answers a trivial query."""
+    try:
+        cursor = db.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+class ConnectionPool:
+    """
+    Hand out at most `size` connections made by `connect`, reusing
+    idle ones. Idle connections are validated before checkout and
+    replaced when stale. Checkout waits up to `timeout` seconds for a
+    free slot, then raises TimeoutError.
+    """
+
+    def __init__(self, connect: Callable = get_db, size: int = POOL_SIZE,
+                 timeout: float = POOL_TIMEOUT,
+                 validate: Callable = ping):
+        """Initialize an empty pool; connections are opened on demand."""
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.validate = validate
+        self.in_use = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Check out a live connection."""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("no connection available after {}s"
+                               .format(self.timeout))
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time += time.perf_counter() - start
+            db = self._idle.pop() if self._idle else None
+
+        try:
+            if db is not None and not self.validate(db):
+                self._discard(db)
+                db = None
+            if db is None:
+                db = self.connect()
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+            raise
+        return db
+
+    def release(self, db):
+        """Return a checked out connection to the pool."""
+        with self._lock:
+            self.in_use -= 1
+            self._idle.append(db)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block."""
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def stats(self) -> dict:
+        """Return the in use, idle and cumulative wait figures."""
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                "checkouts": self.checkouts,
+                "wait_time": self.wait_time,
+            }
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            self._discard(db)
+
+    @staticmethod
+    def _discard(db):
+        """Close a connection, ignoring errors from a dead one."""
+        try:
+            db.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
+    """
+    Return the shared pool of get_db connections, sized by
+    PERSONAL_DATA_DB_POOL_SIZE and PERSONAL_DATA_DB_POOL_TIMEOUT.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                get_db,
+                int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", POOL_SIZE)),
+                float(os.getenv("PERSONAL_DATA_DB_POOL_TIMEOUT",
+                                POOL_TIMEOUT)))
+        return _pool
+
+
+def fetch_rows(cursor, batch_size: int) -> Iterator[tuple]:
+    """Yield the rows of an executed cursor, batch_size at a time."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def row_message(columns: List[str], row: tuple) -> str:
+    """Turn a row into a `key=value; ` log message."""
+    return "; ".join(f"{key}={value}"
+                     for key, value in zip(columns, row)) + ";"
+
+
+def row_messages(columns: List[str], rows: Iterable[tuple]) -> Iterator[str]:
+    """Turn each row into a `key=value; ` log message."""
+    for row in rows:
+        yield row_message(columns, row)
+
+
+def key_ranges(db, key: str, range_size: int) -> List[Tuple[int, int]]:
+    """Split the users table into [start, stop) ranges of its integer key."""
+    cursor = db.cursor()
+    cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM users")
+    low, high = cursor.fetchone()
+    cursor.close()
+    if low is None:
+        return []
+    return [(start, min(start + range_size, high + 1))
+            for start in range(int(low), int(high) + 1, range_size)]
+
+
+def export_range(task: Tuple[Callable, str, int, int, int]) -> List[str]:
+    """
+    Fetch one key range on its own connection and return its rows
+    as redacted log lines. Runs inside a worker process.
+    """
+    connect, key, start, stop, batch_size = task
+    db = connect()
+    cursor = db.cursor()
+    cursor.execute(f"SELECT * FROM users WHERE {key} >= {start:d} "
+                   f"AND {key} < {stop:d} ORDER BY {key}")
+    columns = [desc[0] for desc in cursor.description]
+
+    formatter = RedactingFormatter(PII_FIELDS)
+    lines = [formatter.format(logging.LogRecord(
+                 "user_data", logging.INFO, None, None, message, None, None))
+             for message in row_messages(columns,
+                                         fetch_rows(cursor, batch_size))]
+
+    cursor.close()
+    db.close()
+    return lines
+
+
+def export_parallel(stream: TextIO, workers: int = None, key: str = "id",
+                    range_size: int = RANGE_SIZE,
+                    batch_size: int = BATCH_SIZE,
+                    connect: Callable = get_db):
+    """
+    Export the users table with a pool of worker processes.
+
+    The table is split into ranges of its integer primary key. Each
+    worker fetches a range on its own connection and redacts it; the
+    lines are written to stream in key order, whatever the worker count.
+    """
+    db = connect()
+    ranges = key_ranges(db, key, range_size)
+    db.close()
+
+    tasks = [(connect, key, start, stop, batch_size)
+             for start, stop in ranges]
+    with Pool(workers) as pool:
+        # imap hands results back in task order
+        for lines in pool.imap(export_range, tasks):
+            for line in lines:
+                stream.write(line + "\n")
+    stream.flush()
+
+
+def holberton_lines(columns: List[str], rows: List[list]) -> List[str]:
+    """Render redacted rows in the RedactingFormatter line format."""
+    now = time.time()
+    asctime = "{},{:03d}".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+        int(now * 1000) % 1000)
+    prefix = f"[HOLBERTON] user_data INFO {asctime:<15}: "
+    return [prefix + "; ".join(f"{key}={value}"
+                               for key, value in zip(columns, row)) + ";\n"
+            for row in rows]
+
+
+def export_bulk(stream: TextIO, fmt: str = "holberton",
+                batch_size: int = BATCH_SIZE, connect: Callable = get_db,
+                fields: List[str] = PII_FIELDS):
+    """
+    Export the users table straight to stream as csv, jsonl or
+    holberton lines, bypassing logging.
+
+    PII columns are found once from cursor.description and replaced by
+    index, so no message is built and rescanned. Each batch is written
+    with a single call.
+    """
+    if fmt not in ("csv", "jsonl", "holberton"):
+        raise ValueError("fmt must be 'csv', 'jsonl' or 'holberton'")
+
+    db = connect()
+    cursor = db.cursor()
+    cursor.execute("SELECT * FROM users")
+    columns = [desc[0] for desc in cursor.description]
+    redacted = [column in fields for column in columns]
+
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rows = [[RedactingFormatter.REDACTION if hide else value
+                 for hide, value in zip(redacted, row)] for row in rows]
+        if writer is not None:
+            writer.writerows(rows)
+        elif fmt == "jsonl":
+            stream.write("".join(
+                json.dumps(dict(zip(columns, row)), default=str) + "\n"
+                for row in rows))
+        else:
+            stream.write("".join(holberton_lines(columns, rows)))
+    stream.flush()
+
+    cursor.close()
+    db.close()
+
+
+def watermark_value(value):
+    """Return value as stored in the state file: a number or a string."""
+    return value if isinstance(value, (int, float)) else str(value)
+
+
+def load_watermark(state_file: str = WATERMARK_FILE) -> Tuple:
+    """
+    Return the watermark saved by the last incremental run and the keys
+    of the rows already logged at it, or (None, []).
+    """
+    if not os.path.exists(state_file):
+        return None, []
+    with open(state_file, 'r') as f:
+        state = json.load(f)
+    return state.get("watermark"), state.get("seen", [])
+
+
+def save_watermark(watermark, column: str,
+                   state_file: str = WATERMARK_FILE,
+                   seen: Iterable[str] = ()):
+    """Persist the watermark, replacing the state file atomically."""
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({"column": column, "watermark": watermark_value(watermark),
+                   "seen": list(seen)}, f)
+    os.replace(tmp_file, state_file)
+
+
+def export_incremental(column: str = WATERMARK_COLUMN,
+                       state_file: str = WATERMARK_FILE,
+                       batch_size: int = BATCH_SIZE,
+                       connect: Callable = get_db,
+                       placeholder: str = "%s", key: str = None) -> int:
+    """
+    Log only the users rows not logged yet, by their monotonic column,
+    then move the watermark to the newest row logged.
+
+    Rows are selected from the watermark on (>=): with a coarse column
+    such as a timestamp in seconds, a row committed after the last run
+    can share its value. The state file also keeps the rows logged at
+    the watermark, so they are skipped: by their `key` column, or by a
+    SHA-256 of the whole row when there is no key (no PII is stored).
+
+    The column should be indexed so the range predicate is cheap.
+    The placeholder is the driver's parameter marker ("?" for sqlite3).
+    Returns the number of rows logged.
+    """
+    watermark, seen = load_watermark(state_file)
+    seen = set(seen)
+    db = connect()
+    cursor = db.cursor()
+    if watermark is None:
+        cursor.execute(f"SELECT * FROM users ORDER BY {column}")
+    else:
+        cursor.execute(f"SELECT * FROM users WHERE {column} >= "
+                       f"{placeholder} ORDER BY {column}", (watermark,))
+    columns = [desc[0] for desc in cursor.description]
+    index = columns.index(column)
+    key_index = columns.index(key) if key is not None else None
+
+    logger = get_logger()
+    count = 0
+    # Newest value logged and the keys of the rows logged at it
+    newest, at_newest = watermark, list(seen)
+    for row in fetch_rows(cursor, batch_size):
+        message = row_message(columns, row)
+        if key_index is not None:
+            row_key = str(row[key_index])
+        else:
+            row_key = hashlib.sha256(message.encode()).hexdigest()
+        value = watermark_value(row[index])
+        if value == watermark and row_key in seen:
+            continue
+        logger.info(message)
+        if value != newest:
+            newest, at_newest = value, []
+        at_newest.append(row_key)
+        count += 1
+
+    cursor.close()
+    db.close()
+    if count:
+        save_watermark(newest, column, state_file, at_newest)
+    return count
+
+
+def main(batch_size: int = None, workers: int = None):
     """Main function to retrieve and log user data from the database."""
+    if batch_size is None:
+        batch_size = int(os.getenv("PERSONAL_DATA_BATCH_SIZE", BATCH_SIZE))
+    if workers is None:
+        workers = int(os.getenv("PERSONAL_DATA_WORKERS", 1))
+
+    if workers > 1:
+        key = os.getenv("PERSONAL_DATA_EXPORT_KEY", "id")
+        export_parallel(sys.stderr, workers, key, batch_size=batch_size)
+        return
+
+    column = os.getenv("PERSONAL_DATA_WATERMARK_COLUMN")
+    if column is not None:
+        export_incremental(column, batch_size=batch_size,
+                           key=os.getenv("PERSONAL_DATA_EXPORT_KEY"))
+        return
+
+    fmt = os.getenv("PERSONAL_DATA_EXPORT_FORMAT")
+    if fmt is not None:
+        export_bulk(sys.stdout, fmt, batch_size)
+        return
+
     db = get_db()
+    # The default cursor is unbuffered: rows stay on the server until
+    # fetched, so only one batch is held in memory at a time
     cursor = db.cursor()
 
     # Execute the query to retrieve all rows from the users table
@@ -99,16 +1086,8 @@ def main():
 
     logger = get_logger()
 
-    # Iterate through each row in the result set
-    for row in cursor.fetchall():
-        # Create a dictionary mapping columns to values
-        row_dict = dict(zip(columns, row))
-
-        # Convert the dictionary to a log message string
-        log_message = "; ".join(f"{key}={value}"
-                                for key, value in row_dict.items()) + ";"
-
-        # Log the message using the logger
+    # Stream each row through to the logger
+    for log_message in row_messages(columns, fetch_rows(cursor, batch_size)):
         logger.info(log_message)
 
     # Close the cursor and database connection
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Scrub existing log files with the PII_FIELDS rules of filter_datum.
+
+    ./redact_logs.py old.log old.redacted.log --workers 8
+
+The input is memory-mapped and cut into line-aligned chunks that a pool
+of processes redacts; the chunks are written back in order. Only a few
+chunks are held at once, so memory use does not depend on file size.
+"""
+import argparse
+from collections import deque
+import mmap
+from multiprocessing import Pool
+import os
+import sys
+import time
+from typing import Iterator, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, \
+    get_redaction_engine
+
+# Bytes per chunk handed to a worker, rounded up to the next line end
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Excluding the newline from the value class makes one pass over a chunk
+# equal to filter_datum applied to each of its lines
+ENGINE = get_redaction_engine(PII_FIELDS, RedactingFormatter.REDACTION,
+                              RedactingFormatter.SEPARATOR + "\n")
+
+
+def line_chunks(mm: mmap.mmap,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, int]]:
+    """Yield [start, end) offsets of chunks that end on a line break."""
+    start = 0
+    size = len(mm)
+    while start < size:
+        end = start + chunk_size
+        if end >= size:
+            end = size
+        else:
+            newline = mm.find(b"\n", end - 1)
+            end = size if newline == -1 else newline + 1
+        yield start, end
+        start = end
+
+
+def redact_chunk(task: Tuple[str, int, int]) -> bytes:
+    """Map one chunk of the input and return it redacted."""
+    path, start, end = task
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode("utf-8", "surrogateescape")
+    return ENGINE.redact(text).encode("utf-8", "surrogateescape")
+
+
+def redact_file(source: str, destination: str, workers: int = None,
+                chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Redact source into destination and return the number of bytes read.
+    """
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(source)
+
+    with open(destination, "wb", buffering=chunk_size) as out:
+        if size == 0:
+            return 0
+        with open(source, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                Pool(workers) as pool:
+            pending = deque()
+            for start, end in line_chunks(mm, chunk_size):
+                if len(pending) >= 2 * workers:
+                    out.write(pending.popleft().get())
+                pending.append(pool.apply_async(redact_chunk,
+                                                ((source, start, end),)))
+            while pending:
+                out.write(pending.popleft().get())
+    return size
+
+
+def main():
+    """Parse the command line and redact the file."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    size = redact_file(args.source, args.destination, args.workers,
+                       args.chunk_size)
+    elapsed = time.perf_counter() - start
+    print("{} bytes in {:.2f}s: {:.0f} bytes/sec".format(
+        size, elapsed, size / elapsed if elapsed else 0), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
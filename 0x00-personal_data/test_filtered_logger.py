@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Tests of filtered_logger"""
+import io
+import logging
+import time
+
+import filtered_logger
+from filtered_logger import (BatchRedactingHandler, JsonRedactionEngine,
+                             PII_FIELDS, RedactingFormatter, RedactionEngine,
+                             SamplingFilter, TokenRedactionEngine,
+                             filter_datum)
+
+
+class FakeCursor:
+    """Cursor over fixed rows that records how they are fetched."""
+
+    def __init__(self, columns, rows):
+        """Hold the rows of a users table."""
+        self.description = [(column,) for column in columns]
+        self.rows = list(rows)
+        self.batch_sizes = []
+        self.closed = False
+
+    def execute(self, query, params=None):
+        """Accept the query."""
+        self.query = query
+
+    def fetchmany(self, size):
+        """Return the next size rows."""
+        self.batch_sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        """The export must not load the whole table."""
+        raise AssertionError("fetchall called")
+
+    def close(self):
+        """Close the cursor."""
+        self.closed = True
+
+
+class FakeDb:
+    """Connection handing out one FakeCursor."""
+
+    def __init__(self, cursor):
+        """Wrap the cursor."""
+        self._cursor = cursor
+        self.closed = False
+
+    def cursor(self):
+        """Return the cursor."""
+        return self._cursor
+
+    def close(self):
+        """Close the connection."""
+        self.closed = True
+
+
+def attach(name: str, handler: logging.Handler) -> logging.Logger:
+    """Return a fresh logger writing only to handler."""
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def json_engine() -> JsonRedactionEngine:
+    """Return a JSON engine redacting email."""
+    return JsonRedactionEngine(("email",), "***", ";")
+
+
+def test_json_truncated_string():
+    """A string value never closed is redacted to the end."""
+    assert json_engine().redact('{"email": "unterminated') == \
+        '{"email": "***"'
+
+
+def test_json_truncated_string_with_backslash():
+    """The escaped path redacts a string never closed too."""
+    engine = json_engine()
+    assert engine.redact('{"note": "C:\\\\dir", "email": "unterminated') \
+        == '{"note": "C:\\\\dir", "email": "***"'
+    assert engine.redact('user \\ said {"email": "x') == \
+        'user \\ said {"email": "***"'
+
+
+def test_json_truncated_record_is_logged():
+    """A truncated JSON message still reaches the stream."""
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(RedactingFormatter(["email"], backend="json"))
+    logger = attach("test_json_truncated", handler)
+    logger.error('{"note": "C:\\\\dir", "email": "bob@dylan.com')
+    assert stream.getvalue().endswith(
+        ': {"note": "C:\\\\dir", "email": "***"\n')
+
+
+def test_batch_handler_snapshots_args():
+    """Args changed after the call do not reach the buffered line."""
+    stream = io.StringIO()
+    handler = BatchRedactingHandler(stream, interval=60)
+    logger = attach("test_batch_snapshot", handler)
+    row = {"email": "bob@dylan.com"}
+    logger.info("row %s", row)
+    row["email"] = "CHANGED"
+    fields = {"email": "bob@dylan.com", "role": "admin"}
+    logger.info("fields", extra={"fields": fields})
+    fields["role"] = "CHANGED"
+    handler.flush()
+    lines = stream.getvalue().splitlines()
+    assert lines[0].endswith(": row {'email': 'bob@dylan.com'}")
+    assert lines[1].endswith(": fields email=***; role=admin;")
+
+
+def test_batch_handler_matches_formatter():
+    """The batched output is the output of RedactingFormatter."""
+    stream = io.StringIO()
+    handler = BatchRedactingHandler(stream, interval=60)
+    logger = attach("test_batch_identical", handler)
+    records = []
+    logger.addFilter(lambda record: records.append(record) or True)
+    logger.info("name=bob;email=bob@dylan.com;ssn=123;ip=1.2.3.4;")
+    logger.info("user %s;password=%s;", "bob", "secret")
+    logger.info("plain", extra={"fields": {"phone": "555", "id": 1}})
+    try:
+        raise ValueError("email=bob@dylan.com;")
+    except ValueError:
+        logger.exception("failed;email=bob@dylan.com;")
+    handler.flush()
+
+    formatter = RedactingFormatter(PII_FIELDS)
+    assert stream.getvalue() == "".join(
+        formatter.format(record) + "\n" for record in records)
+
+
+def test_token_engine_matches_regex():
+    """The token backend gives the regex output byte for byte."""
+    fields = ["name", "email", "ssn", "password", "e"]
+    messages = [
+        "name=bob;email=bob@dylan.com;ssn=123;ip=1.2.3.4;",
+        "xname=a;name=;email==x;password=a=b;last_login=now",
+        ";;name=bob;;e=1;  email=x; email=y;username=z;",
+        "noseparator name=bob email=x",
+        "",
+    ]
+    for separator in (";", ",", "|"):
+        regex = RedactionEngine(tuple(fields), "***", separator)
+        tokens = TokenRedactionEngine(tuple(fields), "***", separator)
+        for message in messages:
+            message = message.replace(";", separator)
+            assert tokens.redact(message) == regex.redact(message)
+
+
+def test_main_streams_rows(monkeypatch):
+    """main fetches batch_size rows at a time and logs each row redacted."""
+    columns = ["name", "email", "phone", "ssn", "password", "ip",
+               "last_login", "user_agent"]
+    rows = [("bob{}".format(i), "bob{}@dylan.com".format(i), "555-01",
+             "123-45", "hash{}".format(i), "10.0.0.{}".format(i),
+             "2019-11-14 06:16:24", "Mozilla/5.0")
+            for i in range(7)]
+    cursor = FakeCursor(columns, rows)
+    db = FakeDb(cursor)
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(RedactingFormatter(PII_FIELDS))
+    logger = attach("test_main", handler)
+    monkeypatch.setattr(filtered_logger, "get_db", lambda: db)
+    monkeypatch.setattr(filtered_logger, "get_logger", lambda: logger)
+    for name in ("PERSONAL_DATA_WORKERS", "PERSONAL_DATA_WATERMARK_COLUMN",
+                 "PERSONAL_DATA_EXPORT_FORMAT"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("PERSONAL_DATA_BATCH_SIZE", "3")
+
+    filtered_logger.main()
+
+    assert cursor.batch_sizes == [3, 3, 3, 3]
+    assert cursor.closed and db.closed
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == len(rows)
+    for line, row in zip(lines, rows):
+        message = "; ".join("{}={}".format(column, value)
+                            for column, value in zip(columns, row)) + ";"
+        assert line.endswith(": " + filter_datum(
+            list(PII_FIELDS), "***", message, ";"))
+
+
+def sampled_logger(name: str, **kwargs) -> tuple:
+    """Return a logger with a SamplingFilter, the filter and its output."""
+    stream = io.StringIO()
+    logger = attach(name, logging.StreamHandler(stream))
+    sampling = SamplingFilter(logger, **kwargs)
+    logger.filters = [sampling]
+    return logger, sampling, stream
+
+
+def test_sampling_summary_without_later_records():
+    """Drops are summarized by the timer when nothing else is logged."""
+    logger, sampling, stream = sampled_logger(
+        "test_sampling_quiet", ratios={logging.INFO: 0.0}, interval=0.05)
+    for i in range(3):
+        logger.info("sampled out")
+    deadline = time.monotonic() + 5
+    while "dropped" not in stream.getvalue() \
+            and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stream.getvalue().startswith(
+        "dropped 3 sampled out and 0 rate limited records")
+    sampling.close()
+
+
+def test_sampling_summary_on_close():
+    """Closing the filter summarizes the drops counted so far."""
+    logger, sampling, stream = sampled_logger(
+        "test_sampling_close", rate=1, interval=3600)
+    for i in range(4):
+        logger.info("spike %d", i)
+    sampling.close()
+    assert stream.getvalue().splitlines() == [
+        "spike 0", "dropped 0 sampled out and 3 rate limited records "
+        "in the last 0s"]
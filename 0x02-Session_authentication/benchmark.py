@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+""" Benchmarks of the models storage, printed as JSON
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from typing import List
+
+from models import base
+from models.base import TIMESTAMP_FORMAT, JsonEngine
+from models.engine import SqliteEngine
+from models.user import User
+
+
+class DictUser():
+    """ User attributes in a per-instance __dict__, the layout before slots
+    """
+
+    def __init__(self, **kwargs: dict):
+        """ Set the attributes User sets, in the same order
+        """
+        self.id = kwargs.get('id')
+        self.created_at = datetime.strptime(kwargs.get('created_at'),
+                                            TIMESTAMP_FORMAT)
+        self.updated_at = datetime.strptime(kwargs.get('updated_at'),
+                                            TIMESTAMP_FORMAT)
+        self.email = kwargs.get('email')
+        self._password = kwargs.get('_password')
+        self.first_name = kwargs.get('first_name')
+        self.last_name = kwargs.get('last_name')
+
+
+class LegacyUser(User):
+    """ User built the way Base.__init__ did before the fast path
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **kwargs: dict):
+        """ Draw a uuid even when an id is given and parse with strptime
+        """
+        self.id = kwargs.get('id', str(uuid.uuid4()))
+        self.created_at = datetime.strptime(kwargs.get('created_at'),
+                                            TIMESTAMP_FORMAT)
+        self.updated_at = datetime.strptime(kwargs.get('updated_at'),
+                                            TIMESTAMP_FORMAT)
+        self.email = kwargs.get('email')
+        self._password = kwargs.get('_password')
+        self.first_name = kwargs.get('first_name')
+        self.last_name = kwargs.get('last_name')
+
+
+def populate(count: int) -> List[User]:
+    """ Fill DATA with `count` users without touching the disk
+    """
+    base.DATA["User"] = {}
+    User.reset_indexes()
+    users = []
+    for i in range(count):
+        user = User(email="user{}@example.com".format(i),
+                    first_name="First{}".format(i), last_name="Last")
+        user.password = "pwd{}".format(i)
+        base.DATA["User"][user.id] = user
+        User.index(user)
+        users.append(user)
+    return users
+
+
+def bench_save(sizes=(1000, 100000, 1000000), saves: int = 20) -> List[dict]:
+    """ Mean save() latency with full-file rewrites and with the journal
+    """
+    results = []
+    for count in sizes:
+        users = populate(count)
+        User.save_to_file()
+        row = {"users": count}
+        # A rewrite of a million users takes seconds: time fewer of them
+        rounds = {"rewrite": max(1, min(saves, 100000 // count)),
+                  "journal": saves}
+        for mode, journaled in (("rewrite", False), ("journal", True)):
+            User.journaled = journaled
+            start = time.perf_counter()
+            for user in users[:rounds[mode]]:
+                user.save()
+            elapsed = time.perf_counter() - start
+            row[mode + "_ms"] = elapsed / rounds[mode] * 1000
+        User.journaled = base.Base.journaled
+        results.append(row)
+    return results
+
+
+def bench_batch(sizes=(1000, 100000, 1000000),
+                saves: int = 100) -> List[dict]:
+    """ Mean cost per save() of `saves` saves, one by one and in a batch
+    """
+    results = []
+    for count in sizes:
+        users = populate(count)
+        User.save_to_file()
+        row = {"users": count, "saves": saves}
+        # Unbatched, every save rewrites the file: time fewer of them
+        rounds = max(1, min(saves, 100000 // count))
+        start = time.perf_counter()
+        for user in users[:rounds]:
+            user.save()
+        row["single_ms"] = (time.perf_counter() - start) / rounds * 1000
+        start = time.perf_counter()
+        with User.batch():
+            for user in users[:saves]:
+                user.save()
+        row["batch_ms"] = (time.perf_counter() - start) / saves * 1000
+        results.append(row)
+    return results
+
+
+def bench_load(sizes=(100000, 1000000)) -> List[dict]:
+    """ load_from_file time and peak traced memory, eager and lazy, then
+    the time of a first get and of a first indexed search
+    """
+    results = []
+    for count in sizes:
+        users = populate(count)
+        User.save_to_file()
+        target = users[count // 2]
+        del users
+        row = {"users": count}
+        for mode, lazy in (("eager", False), ("lazy", True)):
+            User.lazy = lazy
+            base.DATA["User"] = {}
+            User.reset_indexes()
+            start = time.perf_counter()
+            User.load_from_file()
+            row[mode + "_load_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            User.get(target.id)
+            row[mode + "_get_us"] = (time.perf_counter() - start) * 1e6
+            start = time.perf_counter()
+            User.search({"email": target.email})
+            row[mode + "_search_us"] = (time.perf_counter() - start) * 1e6
+
+            base.DATA["User"] = {}
+            base.PENDING["User"] = {}
+            User.reset_indexes()
+            tracemalloc.start()
+            User.load_from_file()
+            row[mode + "_peak_mb"] = \
+                tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        User.lazy = base.Base.lazy
+        results.append(row)
+    return results
+
+
+def bench_construct(sizes=(100000, 1000000)) -> List[dict]:
+    """ Objects built per second from JSON dictionaries: the former
+    constructor, the current one, and User.load_objects into DATA
+    """
+    results = []
+    for count in sizes:
+        sources = [user.to_json(True) for user in populate(count)]
+        row = {"users": count}
+        for mode in ("legacy", "init", "load"):
+            base.DATA["User"] = {}
+            User.reset_indexes()
+            base.parse_timestamp.cache_clear()
+            start = time.perf_counter()
+            if mode == "legacy":
+                objs = [LegacyUser(**kwargs) for kwargs in sources]
+            elif mode == "init":
+                objs = [User(**kwargs) for kwargs in sources]
+            else:
+                User.load_objects(sources)
+            row[mode + "_per_s"] = count / (time.perf_counter() - start)
+            objs = None
+        results.append(row)
+    return results
+
+
+def bench_memory(sizes=(100000, 1000000)) -> List[dict]:
+    """ Bytes of traced memory per user object, with slots and __dict__
+    """
+    results = []
+    for count in sizes:
+        sources = [user.to_json(True) for user in populate(count)]
+        base.DATA["User"] = {}
+        User.reset_indexes()
+        row = {"users": count}
+        for mode, cls in (("slots", User), ("dict", DictUser)):
+            tracemalloc.start()
+            objs = [cls(**kwargs) for kwargs in sources]
+            row[mode + "_bytes"] = tracemalloc.get_traced_memory()[0] / count
+            tracemalloc.stop()
+            del objs
+        results.append(row)
+    return results
+
+
+def bench_engines(sizes=(1000, 100000, 1000000),
+                  lookups: int = 100) -> List[dict]:
+    """ Load time, then mean save, get, indexed search and count
+    latency, with the JSON and the SQLite engines
+    """
+    results = []
+    for count in sizes:
+        users = populate(count)
+        User.save_to_file()
+        sqlite = SqliteEngine()
+        sqlite.save_many(users)
+        picks = [users[i * count // lookups] for i in range(lookups)]
+        del users
+        # A rewrite of a million users takes seconds: time fewer of them
+        saves = max(1, min(lookups, 100000 // count))
+        row = {"users": count}
+        for mode, engine in (("json", JsonEngine()), ("sqlite", sqlite)):
+            User.engine = engine
+            start = time.perf_counter()
+            User.load_from_file()
+            row[mode + "_load_s"] = time.perf_counter() - start
+
+            timings = (("get", lookups, lambda u: User.get(u.id)),
+                       ("search", lookups,
+                        lambda u: User.search({"email": u.email})),
+                       ("count", lookups, lambda u: User.count()),
+                       ("save", saves, lambda u: User.get(u.id).save()))
+            for name, rounds, call in timings:
+                start = time.perf_counter()
+                for user in picks[:rounds]:
+                    call(user)
+                row["{}_{}_us".format(mode, name)] = \
+                    (time.perf_counter() - start) / rounds * 1e6
+        del User.engine
+        results.append(row)
+    return results
+
+
+def bench_concurrency(sizes=(1000, 100000), readers: int = 4,
+                      writers: int = 2, seconds: float = 5.0) -> List[dict]:
+    """ Reads (a get and an indexed search) per second from reader
+    threads, alone and while writer threads save with each persistence
+    mode; then check that the file reloads with every user
+    """
+    results = []
+    for count in sizes:
+        users = populate(count)
+        User.save_to_file()
+        row = {"users": count, "readers": readers, "writers": writers}
+        errors = []
+
+        def read(rounds: list, seed: int, stop: threading.Event):
+            """ Look users up until stopped """
+            pick = random.Random(seed).choice
+            try:
+                while not stop.is_set():
+                    user = pick(users)
+                    User.get(user.id)
+                    User.search({"email": user.email})
+                    rounds[seed] += 1
+            except Exception as e:
+                errors.append(repr(e))
+
+        def write(rounds: list, seed: int, stop: threading.Event):
+            """ Save users until stopped """
+            pick = random.Random(seed).choice
+            try:
+                while not stop.is_set():
+                    pick(users).save()
+                    rounds[seed] += 1
+            except Exception as e:
+                errors.append(repr(e))
+
+        for mode in ("idle", "rewrite", "journal"):
+            User.journaled = mode == "journal"
+            stop = threading.Event()
+            reads, saves = [0] * readers, [0] * (writers + readers)
+            threads = [threading.Thread(target=read, args=(reads, i, stop))
+                       for i in range(readers)]
+            if mode != "idle":
+                threads += [threading.Thread(target=write,
+                                             args=(saves, readers + i, stop))
+                            for i in range(writers)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            row[mode + "_reads_per_s"] = sum(reads) / elapsed
+            if mode != "idle":
+                row[mode + "_saves_per_s"] = sum(saves) / elapsed
+
+            User.load_from_file()
+            if User.count() != count:
+                errors.append("{}: {} users reloaded".format(
+                    mode, User.count()))
+            users = User.all()
+        User.journaled = base.Base.journaled
+        row["errors"] = errors
+        results.append(row)
+    return results
+
+
+def bench_search(sizes=(1000, 100000, 1000000),
+                 lookups: int = 100) -> List[dict]:
+    """ Mean User.search({"email": ...}) latency, indexed and scanning
+    """
+    results = []
+    for count in sizes:
+        users = populate(count)
+        emails = [users[i * count // lookups].email for i in range(lookups)]
+        row = {"users": count}
+        for mode, indexes in (("scan", ()), ("index", User.indexes)):
+            saved, User.indexes = User.indexes, indexes
+            start = time.perf_counter()
+            for email in emails:
+                User.search({"email": email})
+            row[mode + "_us"] = (time.perf_counter() - start) / lookups * 1e6
+            User.indexes = saved
+        results.append(row)
+    return results
+
+
+def main():
+    """ Run the chosen suite in a scratch directory
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suite", default="save",
+                        choices=("save", "batch", "concurrency", "construct",
+                                 "engines", "load", "memory", "search"))
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 100000, 1000000])
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    if args.suite == "save":
+        results = bench_save(args.sizes)
+    elif args.suite == "batch":
+        results = bench_batch(args.sizes)
+    elif args.suite == "concurrency":
+        results = bench_concurrency(args.sizes)
+    elif args.suite == "construct":
+        results = bench_construct(args.sizes)
+    elif args.suite == "engines":
+        results = bench_engines(args.sizes)
+    elif args.suite == "load":
+        results = bench_load(args.sizes)
+    elif args.suite == "memory":
+        results = bench_memory(args.sizes)
+    elif args.suite == "search":
+        results = bench_search(args.sizes)
+
+    json.dump({"suite": args.suite, "results": results}, sys.stdout,
+              indent=2)
+    print()
+    # The concurrency suite reports what went wrong in "errors"
+    if any(row.get("errors") for row in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,35 +3,278 @@
 """
 from datetime import datetime
 from typing import TypeVar, List, Iterable
-from os import path
+from os import getenv, path
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 import json
+import os
+import re
+import threading
 import uuid
 
+from models.engine import Engine, SqliteEngine
+
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Distinct timestamp strings whose parsed datetime is kept
+TIMESTAMP_CACHE_SIZE = 4096
 DATA = {}
 
+# {class: {id: JSON text}} of stored objects not built yet (lazy mode)
+PENDING = {}
+
+# {class: {attribute: {value: {id: object}}}} for each indexed attribute;
+# objects still in PENDING are indexed with None in place of the object
+INDEXES = {}
+# {class: {id: {attribute: value}}}, the values each object is indexed by
+INDEXED = {}
+# {class: set of ids} whose indexed attributes changed since indexed
+CHANGED = {}
+
+# Journal size, in bytes, that triggers a fresh snapshot
+JOURNAL_THRESHOLD = 4 * 1024 * 1024
+
+# Characters of the snapshot read at a time in lazy mode
+LAZY_CHUNK_SIZE = 1024 * 1024
+_SEPARATOR = re.compile(r"[\s,]*")
+_COLON = re.compile(r"\s*:\s*")
+
+# Stands for a slot that was never assigned
+_UNSET = object()
+
+# Per-thread writes held back by an open Base.batch()
+_batch = threading.local()
+
+
+class ReadWriteLock():
+    """ Lock shared by readers and exclusive to one writer
+
+    Waiting writers go before new readers, and readers waiting when a
+    writer is done go before the next writer, so neither side starves.
+    The thread holding the write lock may take it again, or the read
+    lock, without blocking.
+    """
+
+    def __init__(self):
+        """ Start unlocked
+        """
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.readers_waiting = 0
+        self.writers_waiting = 0
+        self.writer = None
+        self.readers_turn = False
+
+    @contextmanager
+    def reading(self):
+        """ Hold the lock shared for the block
+        """
+        if self.writer == threading.get_ident():
+            yield
+            return
+        with self.condition:
+            self.readers_waiting += 1
+            while self.writer is not None or \
+                    (self.writers_waiting and not self.readers_turn):
+                self.condition.wait()
+            self.readers_waiting -= 1
+            self.readers += 1
+            if not self.readers_waiting:
+                self.readers_turn = False
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        """ Hold the lock exclusively for the block
+        """
+        if self.writer == threading.get_ident():
+            yield
+            return
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer is not None or self.readers or \
+                    self.readers_turn:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = threading.get_ident()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = None
+                self.readers_turn = self.readers_waiting > 0
+                self.condition.notify_all()
+
+
+# Guards DATA, PENDING and the indexes against concurrent requests
+DATA_LOCK = ReadWriteLock()
+# Readers building pending objects take turns
+_materialize_lock = threading.Lock()
+# {class: lock}, held while the snapshot of the class is written
+_file_locks = {}
+# {class: number of changes}, counted under the write lock
+_versions = {}
+# {class: the number of changes in the last snapshot written}
+_written = {}
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT string
+    """
+    # fromisoformat reads exactly this layout, much faster than strptime
+    if len(value) == 19 and value[4] == value[7] == "-" and \
+            value[10] == "T" and value[13] == value[16] == ":":
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def hashable(value) -> bool:
+    """ Whether value can be a dict key, and so be indexed
+    """
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class IndexedAttribute(property):
+    """ Stands in for the slot of an indexed attribute: an assignment to
+    an indexed object puts its id in CHANGED, so search still finds it
+    by the new value before it is saved. Reads go straight to the slot.
+    """
+
+    def __init__(self, name: str, slot=None):
+        """ Wrap the slot descriptor, or the __dict__ entry if None
+        """
+        self.name = name
+        self.slot = slot
+        super().__init__(slot.__get__ if slot is not None else self.read,
+                         self.write, self.empty)
+
+    def read(self, obj):
+        """ Read the attribute from the __dict__ of obj
+        """
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def write(self, obj, value):
+        """ Write the attribute and note the change
+        """
+        if self.slot is not None:
+            self.slot.__set__(obj, value)
+        else:
+            obj.__dict__[self.name] = value
+        self.changed(obj)
+
+    def empty(self, obj):
+        """ Delete the attribute and note the change
+        """
+        if self.slot is not None:
+            self.slot.__delete__(obj)
+        else:
+            obj.__dict__.pop(self.name, None)
+        self.changed(obj)
+
+    @staticmethod
+    def changed(obj):
+        """ Put the id of obj in CHANGED if it is indexed
+        """
+        s_class = type(obj).__name__
+        obj_id = getattr(obj, "id", None)
+        if obj_id in INDEXED.get(s_class, ()):
+            CHANGED.setdefault(s_class, set()).add(obj_id)
+
+
+@lru_cache(maxsize=None)
+def slot_names(cls: type) -> tuple:
+    """ Names of the slots of a class and its bases, bases first
+    """
+    names = ()
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get("__slots__", ())
+        names += (slots,) if isinstance(slots, str) else tuple(slots)
+    return names
+
 
 class Base():
     """ Base class
+
+    With `journaled` set (DB_JOURNAL=1), save and remove append one line
+    to .db_<class>.journal instead of rewriting .db_<class>.json;
+    the snapshot is rewritten once the journal passes JOURNAL_THRESHOLD.
+
+    Subclasses list attributes in `indexes` to get a hash index on them;
+    search uses it when filtering on one of them. Indexes hold the values
+    as of the last save; objects whose indexed attributes changed since
+    are checked by search too.
+
+    bulk_create stores many new objects with a single write.
+
+    Inside `with Base.batch():` save and remove only update memory; each
+    class written to is flushed once when the block exits.
+
+    With `lazy` set (DB_LAZY=1), load_from_file only keeps the JSON text
+    of each stored object; objects are built the first time get or
+    search returns them.
+
+    Attributes live in `__slots__`, not in a per-instance __dict__, for
+    Base and for subclasses that declare their own `__slots__`.
+
+    `engine` stores the objects: a JsonEngine by default, which the
+    options above configure, or a SqliteEngine with DB_ENGINE=sqlite.
     """
 
+    __slots__ = ("id", "created_at", "updated_at")
+
+    journaled = getenv("DB_JOURNAL") == "1"
+    lazy = getenv("DB_LAZY") == "1"
+    indexes = ()
+    # Set at the end of the module
+    engine = None
+
+    def __init_subclass__(cls, **kwargs: dict):
+        """ Watch the indexed attributes of a subclass for changes
+        """
+        super().__init_subclass__(**kwargs)
+        for attribute in cls.indexes:
+            for klass in cls.__mro__:
+                slot = klass.__dict__.get(attribute)
+                if slot is not None:
+                    break
+            if isinstance(slot, IndexedAttribute):
+                continue
+            if not hasattr(slot, "__set__"):
+                slot = None
+            setattr(cls, attribute, IndexedAttribute(attribute, slot))
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
         if DATA.get(s_class) is None:
             DATA[s_class] = {}
+            self.__class__.reset_indexes()
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
+        self.id = kwargs['id'] if 'id' in kwargs else str(uuid.uuid4())
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = parse_timestamp(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = parse_timestamp(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
 
@@ -44,11 +287,32 @@ class Base():
             return False
         return (self.id == other.id)
 
+    def attributes(self) -> List[tuple]:
+        """ (name, value) of each attribute, _UNSET for an empty slot
+        """
+        items = [(key, getattr(self, key, _UNSET))
+                 for key in slot_names(type(self))]
+        items.extend(getattr(self, "__dict__", {}).items())
+        return items
+
+    def restore(self, attributes: List[tuple]):
+        """ Put back the attributes returned by attributes()
+        """
+        if hasattr(self, "__dict__"):
+            self.__dict__.clear()
+        for key, value in attributes:
+            if value is not _UNSET:
+                setattr(self, key, value)
+            elif hasattr(self, key):
+                delattr(self, key)
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
         result = {}
-        for key, value in self.__dict__.items():
+        for key, value in self.attributes():
+            if value is _UNSET:
+                continue
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
@@ -61,52 +325,340 @@ class Base():
     def load_from_file(cls):
         """ Load all objects from file
         """
+        cls.engine.load(cls)
+
+    @classmethod
+    def bulk_create(cls, objs_json: Iterable[dict]) -> int:
+        """ Build objects from their JSON dictionaries and store them with
+        the engine in one write; return how many
+        """
+        objs = [cls(**obj_json) for obj_json in objs_json]
+        cls.engine.save_many(objs)
+        return len(objs)
+
+    @classmethod
+    def load_objects(cls, objs_json: Iterable[dict]) -> int:
+        """ Build objects from their JSON dictionaries and add them to DATA
+        and the indexes, without writing anything; return how many
+        """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
+        with DATA_LOCK.writing():
+            if DATA.get(s_class) is None:
+                DATA[s_class] = {}
+                cls.reset_indexes()
+            objs = DATA[s_class]
+            pending = PENDING.get(s_class)
+            index = cls.index if cls.indexes else None
+            count = 0
+            for obj_json in objs_json:
+                obj = cls(**obj_json)
+                if index is not None:
+                    index(obj)
+                objs[obj.id] = obj
+                if pending:
+                    pending.pop(obj.id, None)
+                count += 1
+            _versions[s_class] = _versions.get(s_class, 0) + 1
+        return count
 
+    @classmethod
+    def scan_file(cls, file_path: str):
+        """ Fill PENDING from a snapshot, reading it a chunk at a time
+        """
+        s_class = cls.__name__
+        pending = PENDING[s_class]
+        decoder = json.JSONDecoder()
         with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+            buffer = f.read(LAZY_CHUNK_SIZE)
+            pos = buffer.index("{") + 1
+            while True:
+                try:
+                    key = _SEPARATOR.match(buffer, pos).end()
+                    if buffer[key] == "}":
+                        return
+                    obj_id, end = decoder.raw_decode(buffer, key)
+                    start = _COLON.match(buffer, end).end()
+                    obj_json, end = decoder.raw_decode(buffer, start)
+                except (ValueError, IndexError, AttributeError):
+                    # The entry runs past the buffer: read on
+                    chunk = f.read(LAZY_CHUNK_SIZE)
+                    if not chunk:
+                        raise
+                    buffer, pos = buffer[pos:] + chunk, 0
+                    continue
+                pending[obj_id] = buffer[start:end]
+                cls.index_values(obj_id, obj_json)
+                pos = end
+
+    @classmethod
+    def materialize(cls, obj_id: str) -> TypeVar('Base'):
+        """ Build a pending object and move it to DATA
+        """
+        s_class = cls.__name__
+        with _materialize_lock:
+            # Another reader may have built it meanwhile
+            obj = DATA[s_class].get(obj_id)
+            if obj is None:
+                obj = cls(**json.loads(PENDING[s_class][obj_id]))
+                cls.index(obj)
+                DATA[s_class][obj_id] = obj
+                del PENDING[s_class][obj_id]
+        return obj
+
+    @classmethod
+    def replay_journal(cls):
+        """ Apply the journal on top of the loaded snapshot
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        if not path.exists(journal_path):
+            return
+
+        truncated = False
+        with open(journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    truncated = True
+                    break
+                if entry["op"] == "save":
+                    obj = cls(**entry["obj"])
+                    cls.index(obj)
+                    DATA[s_class][obj.id] = obj
+                    PENDING[s_class].pop(obj.id, None)
+                else:
+                    DATA[s_class].pop(entry["id"], None)
+                    PENDING[s_class].pop(entry["id"], None)
+                    cls.unindex(entry["id"])
+
+        # A crash mid-append leaves a truncated last line: snapshot now
+        # so later appends do not land after it
+        if truncated:
+            cls.save_to_file()
+
+    @classmethod
+    def reset_indexes(cls):
+        """ Empty the indexes of the class
+        """
+        s_class = cls.__name__
+        INDEXES[s_class] = {attribute: {} for attribute in cls.indexes}
+        INDEXED[s_class] = {}
+        CHANGED[s_class] = set()
+
+    @classmethod
+    def index(cls, obj: TypeVar('Base')):
+        """ Index an object by its current attribute values
+        """
+        if not cls.indexes:
+            return
+        cls.index_values(obj.id, {attribute: getattr(obj, attribute, None)
+                                  for attribute in cls.indexes}, obj)
+
+    @classmethod
+    def index_values(cls, obj_id: str, values: dict,
+                     obj: TypeVar('Base') = None):
+        """ Index an id by the indexed attributes found in values; values
+        that cannot be hashed are left out, search scans for those
+        """
+        if not cls.indexes:
+            return
+        s_class = cls.__name__
+        cls.unindex(obj_id)
+        indexed = {}
+        for attribute in cls.indexes:
+            value = values.get(attribute)
+            if not hashable(value):
+                continue
+            INDEXES[s_class][attribute].setdefault(value, {})[obj_id] = obj
+            indexed[attribute] = value
+        INDEXED[s_class][obj_id] = indexed
+
+    @classmethod
+    def unindex(cls, obj_id: str):
+        """ Drop an object from the indexes
+        """
+        s_class = cls.__name__
+        CHANGED.get(s_class, set()).discard(obj_id)
+        values = INDEXED.get(s_class, {}).pop(obj_id, None)
+        if values is None:
+            return
+        for attribute, value in values.items():
+            bucket = INDEXES[s_class][attribute][value]
+            del bucket[obj_id]
+            if not bucket:
+                del INDEXES[s_class][attribute][value]
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
         s_class = cls.__name__
+        if not isinstance(cls.engine, JsonEngine):
+            raise TypeError("{} objects are stored by {}, not in a file"
+                            .format(s_class, type(cls.engine).__name__))
         file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        # Journal appends must not land between the snapshot and the
+        # removal of the journal; a plain rewrite lets requests go on
+        journal_lock = DATA_LOCK.writing() if cls.journaled \
+            else nullcontext()
+        with journal_lock:
+            with DATA_LOCK.reading():
+                version = _versions.get(s_class, 0)
+                objs_json = {}
+                for obj_id, obj in list(DATA[s_class].items()):
+                    objs_json[obj_id] = obj.to_json(True)
+                pending = list(PENDING.get(s_class, {}).items())
+            with _file_locks.setdefault(s_class, threading.Lock()):
+                # A newer snapshot was written while this one waited
+                if _written.get(s_class, -1) > version:
+                    return
+                cls.write_snapshot(file_path, objs_json, pending)
+                _written[s_class] = version
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def write_snapshot(cls, file_path: str, objs_json: dict,
+                       pending: List[tuple]):
+        """ Replace the snapshot file and drop the journal
+        """
+        # Written aside then renamed, so the file is never partial
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            if not pending:
+                json.dump(objs_json, f)
+            else:
+                # Objects never built are written back as they were read
+                entries = ["{}: {}".format(json.dumps(obj_id), text)
+                           for obj_id, text in pending]
+                if objs_json:
+                    entries.insert(0, json.dumps(objs_json)[1:-1])
+                f.write("{" + ", ".join(entries) + "}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+
+        # The snapshot now holds everything the journal recorded
+        journal_path = ".db_{}.journal".format(cls.__name__)
+        if path.exists(journal_path):
+            os.remove(journal_path)
+
+    @classmethod
+    def append_journal(cls, entries: List[dict]):
+        """ Append entries to the journal, compacting when it is large
+        """
+        journal_path = ".db_{}.journal".format(cls.__name__)
+        with open(journal_path, 'a') as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            size = f.tell()
+        if size > JOURNAL_THRESHOLD:
+            cls.save_to_file()
+
+    @classmethod
+    def flush(cls, entries: List[dict]):
+        """ Persist the given changes: journal them or rewrite the file
+        """
+        if cls.journaled:
+            with DATA_LOCK.writing():
+                cls.append_journal(entries)
+        else:
+            cls.save_to_file()
+
+    @classmethod
+    def persist(cls, entries: List[dict]):
+        """ Flush changes now, or hold them until the open batch exits
+        """
+        pending = getattr(_batch, "pending", None)
+        if pending is None:
+            cls.flush(entries)
+        else:
+            pending.setdefault(cls, []).extend(entries)
+
+    @classmethod
+    def batch(cls):
+        """ Group writes: the block is written when it exits, or not at all
+        if an exception escapes. Nested batches join the outer one. See
+        the batch of the engine.
+        """
+        return cls.engine.batch(cls)
+
+    @classmethod
+    def loaded_classes(cls) -> List[type]:
+        """ The class, or for Base every subclass with objects in DATA
+        """
+        if cls is not Base:
+            return [cls]
+        classes, found = [Base], []
+        while classes:
+            klass = classes.pop()
+            classes.extend(klass.__subclasses__())
+            if klass is not Base and klass.__name__ in DATA:
+                found.append(klass)
+        return found
+
+    @classmethod
+    def join_batch(cls, obj_id: str = None):
+        """ In an open batch, keep what a rollback needs: the objects of
+        the class and their attributes when it joined, then the ids saved
+        or removed
+        """
+        undo = getattr(_batch, "undo", None)
+        if undo is None:
+            return
+        if cls not in undo:
+            s_class = cls.__name__
+            with DATA_LOCK.reading():
+                undo[cls] = {
+                    "objs": {key: (obj, obj.attributes()) for key, obj
+                             in list(DATA.get(s_class, {}).items())},
+                    "pending": dict(PENDING.get(s_class, {})),
+                    "written": _written.get(s_class),
+                    "ids": set(),
+                }
+        if obj_id is not None:
+            undo[cls]["ids"].add(obj_id)
+
+    @classmethod
+    def rollback_batch(cls, state: dict):
+        """ Give the objects changed in a batch their state from before
+        """
+        s_class = cls.__name__
+        with DATA_LOCK.writing():
+            objs, pending = DATA[s_class], PENDING.setdefault(s_class, {})
+            for obj_id in state["ids"]:
+                cls.unindex(obj_id)
+                objs.pop(obj_id, None)
+                pending.pop(obj_id, None)
+                if obj_id in state["objs"]:
+                    obj, attributes = state["objs"][obj_id]
+                    obj.restore(attributes)
+                    cls.index(obj)
+                    objs[obj_id] = obj
+                elif obj_id in state["pending"]:
+                    text = state["pending"][obj_id]
+                    cls.index_values(obj_id, json.loads(text))
+                    pending[obj_id] = text
+            _versions[s_class] = _versions.get(s_class, 0) + 1
+            # Another thread wrote DATA, uncommitted changes included
+            rewrite = _written.get(s_class) != state["written"]
+        if rewrite:
+            cls.save_to_file()
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        self.engine.save(self)
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        self.engine.remove(self)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return cls.engine.count(cls)
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,20 +670,165 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return cls.engine.get(cls, id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
+        return cls.engine.search(cls, attributes)
+
+
+class JsonEngine(Engine):
+    """ Objects held in DATA and written to .db_<class>.json (and the
+    journal), as configured on Base
+
+    Reads share DATA_LOCK and changes take it alone; a full rewrite of
+    the file happens after the change, outside the lock.
+    """
+
+    def load(self, cls: type):
+        """ Load all objects from file
+        """
         s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
+        file_path = ".db_{}.json".format(s_class)
+        with DATA_LOCK.writing():
+            DATA[s_class] = {}
+            PENDING[s_class] = {}
+            cls.reset_indexes()
+            if path.exists(file_path) and cls.lazy:
+                cls.scan_file(file_path)
+            elif path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    cls.load_objects(json.load(f).values())
+            cls.replay_journal()
+            _versions[s_class] = _versions.get(s_class, 0) + 1
+
+    @contextmanager
+    def batch(self, cls: type):
+        """ Each class saved to in the block is flushed once on exit. If an
+        exception escapes, nothing is written and the objects saved or
+        removed in the block get back the state they had when their class
+        joined the batch; the file is written again if another thread
+        rewrote it meanwhile.
+
+        Base.batch() joins every loaded class when it opens, Model.batch()
+        that class; a class first saved to in the block joins then.
+        """
+        outer = getattr(_batch, "pending", None) is not None
+        if not outer:
+            _batch.pending, _batch.undo = {}, {}
+        for klass in cls.loaded_classes():
+            klass.join_batch()
+        if outer:
+            yield
+            return
+
+        try:
+            yield
+        except BaseException:
+            undo = _batch.undo
+            _batch.pending = _batch.undo = None
+            for klass, state in undo.items():
+                klass.rollback_batch(state)
+            raise
+        pending = _batch.pending
+        _batch.pending = _batch.undo = None
+        for klass, entries in pending.items():
+            klass.flush(entries)
+
+    def save(self, obj: Base):
+        """ Put an object in DATA and persist it
+        """
+        self.save_many([obj])
+
+    def save_many(self, objs: Iterable[Base]):
+        """ Put objects of one class in DATA and persist them together
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        cls = type(objs[0])
+        s_class = cls.__name__
+        with DATA_LOCK.writing():
+            stored, pending = DATA[s_class], PENDING.get(s_class, {})
+            for obj in objs:
+                cls.join_batch(obj.id)
+                cls.index(obj)
+                stored[obj.id] = obj
+                pending.pop(obj.id, None)
+            _versions[s_class] = _versions.get(s_class, 0) + 1
+            if cls.journaled:
+                # Lines go to the journal in the order of the changes
+                cls.persist([{"op": "save", "obj": obj.to_json(True)}
+                             for obj in objs])
+                return
+        cls.persist([])
+
+    def remove(self, obj: Base):
+        """ Drop an object from DATA and persist that
+        """
+        cls = type(obj)
+        s_class = cls.__name__
+        with DATA_LOCK.writing():
+            cls.join_batch(obj.id)
+            pending = PENDING.get(s_class, {}).pop(obj.id, None)
+            if DATA[s_class].pop(obj.id, None) is None and not pending:
+                return
+            cls.unindex(obj.id)
+            _versions[s_class] = _versions.get(s_class, 0) + 1
+            if cls.journaled:
+                cls.persist([{"op": "remove", "id": obj.id}])
+                return
+        cls.persist([])
+
+    def count(self, cls: type) -> int:
+        """ Count all objects
+        """
+        s_class = cls.__name__
+        with DATA_LOCK.reading():
+            return len(DATA[s_class].keys()) + \
+                len(PENDING.get(s_class, ()))
+
+    def get(self, cls: type, obj_id: str) -> Base:
+        """ Return one object by ID
+        """
+        s_class = cls.__name__
+        with DATA_LOCK.reading():
+            obj = DATA[s_class].get(obj_id)
+            if obj is None and obj_id in PENDING.get(s_class, ()):
+                obj = cls.materialize(obj_id)
+        return obj
+
+    def search(self, cls: type, attributes: dict) -> List[Base]:
+        """ Search all objects with matching attributes
+        """
+        s_class = cls.__name__
+
+        # Narrow down with an index when one covers the predicate, adding
+        # the objects changed since indexed; all candidates are checked
+        with DATA_LOCK.reading():
             for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+                if k in cls.indexes and hashable(v):
+                    bucket = INDEXES[s_class][k].get(v, {})
+                    changed = CHANGED.get(s_class)
+                    if changed:
+                        bucket = dict(bucket)
+                        for obj_id in list(changed):
+                            obj = DATA[s_class].get(obj_id)
+                            if obj is not None:
+                                bucket.setdefault(obj_id, obj)
+                    candidates = [obj if obj is not None
+                                  else cls.materialize(i)
+                                  for i, obj in list(bucket.items())]
+                    break
+            else:
+                for obj_id in list(PENDING.get(s_class, ())):
+                    cls.materialize(obj_id)
+                candidates = list(DATA[s_class].values())
+        return [obj for obj in candidates if self.matches(obj, attributes)]
+
+
+# DB_ENGINE picks where objects are stored; json unless set
+ENGINES = {"json": JsonEngine, "sqlite": SqliteEngine}
+Base.engine = ENGINES[getenv("DB_ENGINE", "json")]()
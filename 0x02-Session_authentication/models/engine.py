@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+""" Storage engines of the models
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import TypeVar, List, Iterable
+import json
+import sqlite3
+import threading
+
+
+SQLITE_FILE = ".db.sqlite3"
+
+
+def quote(name: str) -> str:
+    """ Quote an SQL identifier
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def bindable(value) -> bool:
+    """ Whether value can be stored in an SQLite column as is
+    """
+    return value is None or isinstance(value, (str, int, float, bytes))
+
+
+class Engine(ABC):
+    """ Storage engine: where Base keeps and looks up objects
+
+    Base.load_from_file, save, remove, get, search and count hand over
+    to the `engine` of the class.
+    """
+
+    @staticmethod
+    def matches(obj: TypeVar('Base'), attributes: dict) -> bool:
+        """ Whether obj has all the given attribute values
+        """
+        for k, v in attributes.items():
+            if (getattr(obj, k) != v):
+                return False
+        return True
+
+    @abstractmethod
+    def load(self, cls: type):
+        """ Prepare the storage of a class
+        """
+
+    @abstractmethod
+    def batch(self, cls: type):
+        """ Context manager: write the changes made in the block when it
+        exits, and none of them if an exception escapes
+        """
+
+    @abstractmethod
+    def save(self, obj: TypeVar('Base')):
+        """ Store an object
+        """
+
+    @abstractmethod
+    def save_many(self, objs: Iterable[TypeVar('Base')]):
+        """ Store objects of one class together
+        """
+
+    @abstractmethod
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+
+    @abstractmethod
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return one object by ID, or None
+        """
+
+    @abstractmethod
+    def search(self, cls: type,
+               attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects with matching attributes
+        """
+
+    @abstractmethod
+    def count(self, cls: type) -> int:
+        """ Count the objects of a class
+        """
+
+
+class SqliteEngine(Engine):
+    """ Objects kept in an SQLite database, not in memory
+
+    Each class has a table with the object as JSON text, plus one column
+    with an SQL index for each attribute in its `indexes` (NULL for values
+    SQLite cannot hold). Each thread uses its own connection; every save
+    and remove is committed, unless a batch is open.
+    """
+
+    def __init__(self, file_path: str = SQLITE_FILE):
+        """ Use the database at file_path
+        """
+        self.file_path = file_path
+        self.local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.file_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.tables = set()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """ Commit the block, or let the open batch commit it
+        """
+        connection = self.connection()
+        if getattr(self.local, "buffer", None) is not None:
+            yield connection
+        else:
+            with connection:
+                yield connection
+
+    def table(self, cls: type) -> str:
+        """ Create or update the table of a class; return its quoted name
+        """
+        self.connection()
+        table = quote(cls.__name__)
+        if cls.__name__ in self.local.tables:
+            return table
+
+        with self.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} "
+                "(id TEXT PRIMARY KEY, data TEXT NOT NULL)".format(table))
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info({})".format(table))]
+            for attribute in cls.indexes:
+                if attribute not in columns:
+                    # Fill a new column from the stored objects
+                    connection.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                        table, quote(attribute)))
+                    connection.execute(
+                        "UPDATE {} SET {} = json_extract(data, ?)".format(
+                            table, quote(attribute)),
+                        ("$." + json.dumps(attribute),))
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                        quote("{}_{}".format(cls.__name__, attribute)),
+                        table, quote(attribute)))
+        self.local.tables.add(cls.__name__)
+        return table
+
+    def load(self, cls: type):
+        """ Make sure the table of the class exists
+        """
+        self.table(cls)
+
+    @contextmanager
+    def batch(self, cls: type):
+        """ Run the block in one transaction of this thread's connection.
+        Saves are held and written together with write_many before the
+        next read or remove, and on exit; an exception rolls it all back.
+        Other threads do not see the changes until the commit, and their
+        writes wait for it.
+        """
+        connection = self.connection()
+        if getattr(self.local, "buffer", None) is not None:
+            yield
+            return
+
+        connection.execute("BEGIN")
+        self.local.buffer = {}
+        try:
+            yield
+            self.write_buffer()
+        except BaseException:
+            self.local.buffer = None
+            connection.rollback()
+            # Tables created in the block are gone too
+            self.local.tables = set()
+            raise
+        self.local.buffer = None
+        connection.commit()
+
+    def write_buffer(self):
+        """ Write the saves held by the open batch
+        """
+        buffer = getattr(self.local, "buffer", None)
+        if not buffer:
+            return
+        self.local.buffer = {}
+        for objs in buffer.values():
+            self.write_many(objs.values())
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace one object, or hold it in the open batch
+        """
+        self.save_many([obj])
+
+    def save_many(self, objs: Iterable[TypeVar('Base')]):
+        """ Insert or replace objects of one class, or hold them in the
+        open batch
+        """
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            self.write_many(objs)
+            return
+        for obj in objs:
+            buffer.setdefault(type(obj), {})[obj.id] = obj
+
+    def write_many(self, objs: Iterable[TypeVar('Base')]):
+        """ Insert or replace objects of one class in a single statement
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        cls = type(objs[0])
+        columns = ["id", "data"] + [quote(a) for a in cls.indexes]
+        sql = "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+            self.table(cls), ", ".join(columns),
+            ", ".join("?" * len(columns)))
+        rows = ([obj.id, json.dumps(obj.to_json(True))] +
+                [value if bindable(value) else None for value in
+                 (getattr(obj, a, None) for a in cls.indexes)]
+                for obj in objs)
+        with self.transaction() as connection:
+            connection.executemany(sql, rows)
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object
+        """
+        self.write_buffer()
+        sql = "DELETE FROM {} WHERE id = ?".format(self.table(type(obj)))
+        with self.transaction() as connection:
+            connection.execute(sql, (obj.id,))
+
+    def query(self, sql: str, parameters: list = ()) -> sqlite3.Cursor:
+        """ Run a read, after the saves held by the open batch
+        """
+        connection = self.connection()
+        self.write_buffer()
+        return connection.execute(sql, parameters)
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Build the object stored under obj_id, or return None
+        """
+        row = self.query(
+            "SELECT data FROM {} WHERE id = ?".format(self.table(cls)),
+            (obj_id,)).fetchone()
+        return cls(**json.loads(row[0])) if row is not None else None
+
+    def search(self, cls: type,
+               attributes: dict) -> List[TypeVar('Base')]:
+        """ Select on the indexed attributes, then check all of them on
+        the built objects
+        """
+        where = [(quote(k), v) for k, v in attributes.items()
+                 if k in cls.indexes and bindable(v)]
+        sql = "SELECT data FROM {}".format(self.table(cls))
+        if where:
+            sql += " WHERE " + " AND ".join(
+                "{} IS ?".format(column) for column, _ in where)
+        rows = self.query(sql, [v for _, v in where])
+        objs = (cls(**json.loads(row[0])) for row in rows)
+        return [obj for obj in objs if self.matches(obj, attributes)]
+
+    def count(self, cls: type) -> int:
+        """ Count the rows of the class
+        """
+        return self.query(
+            "SELECT COUNT(*) FROM {}".format(self.table(cls))).fetchone()[0]
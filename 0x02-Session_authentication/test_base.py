@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+""" Tests of models.base
+"""
+import threading
+import time
+
+import pytest
+
+from models.base import DATA_LOCK, JsonEngine, ReadWriteLock
+from models.engine import SqliteEngine
+from models.user import User
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def engine(request, tmp_path, monkeypatch):
+    """ Store users with each engine, in an empty directory
+    """
+    monkeypatch.chdir(tmp_path)
+    engines = {"json": JsonEngine, "sqlite": SqliteEngine}
+    monkeypatch.setattr(User, "engine", engines[request.param]())
+    User.load_from_file()
+    return User.engine
+
+
+def user_json(i: int) -> dict:
+    """ JSON dictionary of the i-th test user
+    """
+    return {"id": "id-{}".format(i), "email": "user{}@example.com".format(i),
+            "created_at": "2024-01-01T00:00:00",
+            "updated_at": "2024-01-01T00:00:00"}
+
+
+def test_bulk_create_is_stored(engine):
+    """ bulk_create stores through the engine of the class
+    """
+    assert User.bulk_create(user_json(i) for i in range(50)) == 50
+    User.load_from_file()
+    assert User.count() == 50
+    assert User.get("id-7").email == "user7@example.com"
+    assert [u.id for u in User.search({"email": "user9@example.com"})] == \
+        ["id-9"]
+
+
+def test_bulk_create_rolls_back_in_batch(engine):
+    """ bulk_create in a failed batch stores nothing
+    """
+    with pytest.raises(RuntimeError):
+        with User.batch():
+            User.bulk_create(user_json(i) for i in range(5))
+            raise RuntimeError
+    User.load_from_file()
+    assert User.count() == 0
+
+
+def test_search_sees_unsaved_changes(tmp_path, monkeypatch):
+    """ An indexed attribute changed without save is searched by its new
+    value, not its old one
+    """
+    monkeypatch.chdir(tmp_path)
+    User.load_from_file()
+    User.bulk_create(user_json(i) for i in range(3))
+    user = User.get("id-1")
+    user.email = "new@example.com"
+    assert User.search({"email": "new@example.com"}) == [user]
+    assert User.search({"email": "user1@example.com"}) == []
+    user.save()
+    assert User.search({"email": "new@example.com"}) == [user]
+    user.email = None
+    assert User.search({"email": "new@example.com"}) == []
+    assert User.search({"email": None}) == [user]
+
+
+def test_save_to_file_needs_json_engine(engine):
+    """ save_to_file refuses to write a file the engine does not read
+    """
+    if isinstance(engine, JsonEngine):
+        User.save_to_file()
+    else:
+        with pytest.raises(TypeError):
+            User.save_to_file()
+
+
+@pytest.mark.parametrize("journaled", [False, True])
+def test_concurrent_reads_and_writes(engine, journaled, monkeypatch):
+    """ Readers and writers run without errors and every write reloads
+    """
+    monkeypatch.setattr(User, "journaled", journaled)
+    User.bulk_create(user_json(i) for i in range(200))
+    errors = []
+
+    def read(seed: int):
+        """ Look users up by id and by email """
+        try:
+            for i in range(300):
+                i = (i * 7 + seed) % 200
+                assert User.get("id-{}".format(i)) is not None
+                assert User.search({"email": user_json(i)["email"]})
+        except BaseException as e:
+            errors.append(e)
+
+    def write(seed: int):
+        """ Change existing users and create new ones """
+        try:
+            for i in range(50):
+                user = User.get("id-{}".format(i * 4 + seed))
+                user.first_name = "writer{}".format(seed)
+                user.save()
+                User(**user_json(1000 * (seed + 1) + i)).save()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(4)]
+    threads += [threading.Thread(target=write, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    User.load_from_file()
+    assert User.count() == 300
+    for seed in range(2):
+        for i in range(50):
+            assert User.get("id-{}".format(i * 4 + seed)).first_name == \
+                "writer{}".format(seed)
+            assert User.get("id-{}".format(1000 * (seed + 1) + i))
+
+
+def test_readers_share_the_lock():
+    """ Two readers hold DATA_LOCK at the same time
+    """
+    both_in = threading.Barrier(2, timeout=5)
+    errors = []
+
+    def read():
+        """ Wait inside the lock for the other reader """
+        try:
+            with DATA_LOCK.reading():
+                both_in.wait()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_waiting_writer_blocks_new_readers():
+    """ A reader arriving after a waiting writer gets in after it
+    """
+    lock = ReadWriteLock()
+    order = []
+
+    def write():
+        """ Take the write lock """
+        with lock.writing():
+            order.append("writer")
+
+    def read():
+        """ Take the read lock """
+        with lock.reading():
+            order.append("reader")
+
+    with lock.reading():
+        writer = threading.Thread(target=write)
+        writer.start()
+        while not lock.writers_waiting:
+            time.sleep(0.001)
+        reader = threading.Thread(target=read)
+        reader.start()
+        while not lock.readers_waiting:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        assert order == []
+    writer.join(5)
+    reader.join(5)
+    assert order == ["writer", "reader"]
+
+
+def test_writer_reenters():
+    """ The writer takes the lock again, shared or not, without blocking
+    """
+    lock = ReadWriteLock()
+    with lock.writing():
+        with lock.writing():
+            with lock.reading():
+                assert lock.writer == threading.get_ident()
+    assert lock.writer is None